@@ -0,0 +1,135 @@
+"""Generates synthetic Sphinx projects, to benchmark the HyperHelp builder."""
+
+import random
+from pathlib import Path
+
+import func_argparse
+
+CONF_PY = """
+project = "Synthetic"
+extensions = ["sphinx_hyperhelp"]
+hyperhelp_prune_topics = True
+"""
+
+WORDS = (
+    "the builder reads each document and writes a help file with topics links "
+    "anchors and references to other sections of the documentation while sublime "
+    "text renders the result for readers who want to browse python docs offline"
+).split()
+
+
+def sentence(rng: random.Random, n_words: int = 12) -> str:
+    return " ".join(rng.choice(WORDS) for _ in range(n_words)).capitalize() + "."
+
+
+def paragraph(rng: random.Random, n_sentences: int = 5) -> str:
+    return " ".join(sentence(rng) for _ in range(n_sentences))
+
+
+def label(doc: int, section: int) -> str:
+    return f"doc{doc}-section{section}"
+
+
+def xref(rng: random.Random, docs: int, sections: int) -> str:
+    doc, section = rng.randrange(docs), rng.randrange(sections)
+    kind = rng.randrange(3)
+    if kind == 0:
+        return f":ref:`section {section} <{label(doc, section)}>`"
+    elif kind == 1:
+        return f":doc:`doc{doc}`"
+    else:
+        return f"`example <https://example.com/{doc}/{section}>`__"
+
+
+def prose_doc(
+    rng: random.Random,
+    doc: int,
+    docs: int,
+    sections: int,
+    xrefs: int,
+    literal_lines: int,
+) -> str:
+    title = f"Document {doc}"
+    lines = [title, "=" * len(title), "", paragraph(rng), ""]
+    for section in range(sections):
+        section_title = f"Section {doc}.{section}"
+        lines += [f".. _{label(doc, section)}:", "", section_title]
+        lines += ["-" * len(section_title), "", paragraph(rng)]
+        refs = ", ".join(xref(rng, docs, sections) for _ in range(xrefs))
+        lines += [f"See also {refs}.", ""]
+        lines += ["::", ""]
+        lines += [f"   line_{i} = compute({i}, 'value')" for i in range(literal_lines)]
+        lines += [""]
+    return "\n".join(lines)
+
+
+def api_doc(rng: random.Random, doc: int, docs: int, sections: int) -> str:
+    title = f"API {doc}"
+    lines = [title, "=" * len(title), "", f".. py:module:: module{doc}", ""]
+    for section in range(sections):
+        lines += [f".. _{label(doc, section)}:", ""]
+        lines += [f".. py:class:: Class{section}(arg, *, option=None)", ""]
+        lines += ["   " + paragraph(rng, 2), ""]
+        for method in range(5):
+            lines += [f"   .. py:method:: method{method}(self, x, y=0)", ""]
+            lines += ["      " + sentence(rng), ""]
+            lines += [f"      Returns :py:class:`Class{rng.randrange(sections)}`.", ""]
+        lines += [f"   .. py:attribute:: attribute{section}", ""]
+        lines += ["      " + sentence(rng), ""]
+    return "\n".join(lines)
+
+
+def targets_doc(rng: random.Random, targets: int) -> str:
+    """A glossary-like document, where most blocks are targets or anchors."""
+    lines = ["Targets", "=======", ""]
+    for i in range(targets):
+        kind = i % 4
+        if kind == 0:
+            lines += [f".. _target-{i}:", "", paragraph(rng, 1), ""]
+        elif kind == 1:
+            lines += [f"Term {i}", f"   The _`inline-{i}` target. " + sentence(rng), ""]
+        elif kind == 2:
+            lines += [".. glossary::", "", f"   glossary {i}", "      " + sentence(rng)]
+            lines += [""]
+        else:
+            lines += [f".. py:function:: function{i}(x)", "", "   " + sentence(rng), ""]
+    return "\n".join(lines)
+
+
+def generate(
+    srcdir: Path,
+    docs: int = 200,
+    sections: int = 10,
+    xrefs: int = 5,
+    api_ratio: float = 0.25,
+    literal_lines: int = 20,
+    seed: int = 0,
+) -> Path:
+    """Generates a synthetic Sphinx project.
+
+    - srcdir: output folder
+    - docs: number of documents
+    - sections: number of sections (or classes for API pages) per document
+    - xrefs: number of cross references per section
+    - api_ratio: fraction of the documents that are API pages
+    - literal_lines: number of lines of the literal block of each section
+    - seed: random seed, the same seed generates the same project
+    """
+    rng = random.Random(seed)
+    srcdir.mkdir(parents=True, exist_ok=True)
+    (srcdir / "conf.py").write_text(CONF_PY)
+    toctree = "\n".join(f"   doc{i}" for i in range(docs))
+    (srcdir / "index.rst").write_text(
+        f"Synthetic\n=========\n\n.. toctree::\n   :maxdepth: 1\n\n{toctree}\n"
+    )
+    for doc in range(docs):
+        if rng.random() < api_ratio:
+            text = api_doc(rng, doc, docs, sections)
+        else:
+            text = prose_doc(rng, doc, docs, sections, xrefs, literal_lines)
+        (srcdir / f"doc{doc}.rst").write_text(text)
+    return srcdir
+
+
+if __name__ == "__main__":
+    func_argparse.single_main(generate)
@@ -0,0 +1,217 @@
+"""Times each phase of the HyperHelp builder on a synthetic Sphinx project.
+
+Usage:
+    python -m benchmarks.run run --docs 500
+    python -m benchmarks.run compare build/benchmarks/old.json build/benchmarks/new.json
+"""
+
+import functools
+import io
+import json
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Callable, Dict, Iterator, Tuple
+
+import func_argparse
+import sphinx
+from sphinx.application import Sphinx
+
+from sphinx_hyperhelp.help_builder import peak_rss_mb
+from sphinx_hyperhelp.hyperhelp import HelpIndex
+from sphinx_hyperhelp.translate import parse_rst, translate_doctree
+
+from .generate import generate, targets_doc
+
+PHASES = ["read", "write", "validate", "prune", "save"]
+RESULTS_DIR = Path("build") / "benchmarks"
+
+
+def timed(timings: Dict[str, float], phase: str, fn: Callable) -> Callable:
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            timings[phase] = timings.get(phase, 0.0) + time.perf_counter() - start
+
+    return wrapper
+
+
+def build(srcdir: Path, builddir: Path, jobs: int = 1) -> Dict[str, float]:
+    """Builds the project in this process, and returns the duration of each phase."""
+    warnings = io.StringIO()
+    app = Sphinx(
+        str(srcdir),
+        str(srcdir),
+        str(builddir / "hyperhelp"),
+        str(builddir / "doctrees"),
+        "hyperhelp",
+        status=None,
+        warning=warnings,
+        parallel=jobs,
+    )
+    timings: Dict[str, float] = {}
+    builder = app.builder
+    builder.read = timed(timings, "read", builder.read)  # type: ignore
+    builder.write = timed(timings, "write", builder.write)  # type: ignore
+    builder.validate = timed(timings, "validate", builder.validate)  # type: ignore
+    builder.save_index = timed(timings, "save", builder.save_index)  # type: ignore
+
+    # HelpIndex is immutable, so we patch the class.
+    prune = HelpIndex.prune
+    HelpIndex.prune = timed(timings, "prune", prune)  # type: ignore
+    try:
+        start = time.perf_counter()
+        app.build()
+        timings["total"] = time.perf_counter() - start
+    finally:
+        HelpIndex.prune = prune  # type: ignore
+    timings["warnings"] = len(warnings.getvalue().splitlines())
+    return timings
+
+
+def startup(runs: int = 5) -> Dict[str, float]:
+    """Time to start the command line and print its help, the best of `runs`.
+
+    This should stay fast, because Sphinx is only imported to build.
+    """
+    cmd = [sys.executable, "-m", "sphinx_hyperhelp", "--help"]
+    durations = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(cmd, check=True, stdout=subprocess.DEVNULL)
+        durations.append(time.perf_counter() - start)
+    return {"total": min(durations)}
+
+
+def targets(count: int = 2000, runs: int = 5) -> Dict[str, float]:
+    """Time to read and translate one document with `count` targets.
+
+    The translation is the best of `runs`, the doctree is only read once.
+    """
+    timings: Dict[str, float] = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        (Path(tmp) / "conf.py").write_text("")
+        app = Sphinx(
+            tmp,
+            tmp,
+            f"{tmp}/out",
+            f"{tmp}/doctrees",
+            "hyperhelp",
+            status=None,
+            warning=io.StringIO(),
+        )
+        text = targets_doc(random.Random(0), count)
+        start = time.perf_counter()
+        doctree = parse_rst(app, text)
+        timings["read"] = time.perf_counter() - start
+        durations = []
+        for _ in range(runs):
+            copy = doctree.deepcopy()
+            start = time.perf_counter()
+            translate_doctree(copy, app.config)
+            durations.append(time.perf_counter() - start)
+        timings["write"] = min(durations)
+    timings["total"] = timings["read"] + timings["write"]
+    return timings
+
+
+def scenarios(srcdir: Path, builddir: Path, jobs: int) -> Iterator[Tuple[str, dict]]:
+    yield "cold", build(srcdir, builddir, jobs)
+    yield "noop", build(srcdir, builddir, jobs)
+    # Modify one document, and rebuild.
+    doc = srcdir / "doc0.rst"
+    doc.write_text(doc.read_text() + "\nOne more paragraph.\n")
+    yield "incremental", build(srcdir, builddir, jobs)
+
+
+def run(
+    docs: int = 200,
+    sections: int = 10,
+    xrefs: int = 5,
+    api_ratio: float = 0.25,
+    literal_lines: int = 20,
+    jobs: int = 1,
+    seed: int = 0,
+    output: Path = None,
+) -> Path:
+    """Generates a synthetic project, builds it and saves the timings as json.
+
+    - docs, sections, xrefs, api_ratio, literal_lines, seed: see generate.py
+    - jobs: number of parallel processes used by Sphinx
+    - output: json file for the results. Defaults to build/benchmarks/<date>.json
+    """
+    params = dict(
+        docs=docs,
+        sections=sections,
+        xrefs=xrefs,
+        api_ratio=api_ratio,
+        literal_lines=literal_lines,
+        seed=seed,
+    )
+    results: dict = {
+        "date": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "sphinx": sphinx.__display_version__,
+        "jobs": jobs,
+        "params": params,
+        "scenarios": {},
+    }
+    results["scenarios"]["startup"] = startup()
+    print(f"{'startup':<12} total: {results['scenarios']['startup']['total']:.3f}s")
+    results["scenarios"]["targets"] = timings = targets()
+    print_timings("targets", timings)
+    with tempfile.TemporaryDirectory() as tmp:
+        srcdir = generate(Path(tmp) / "src", **params)  # type: ignore
+        for name, timings in scenarios(srcdir, Path(tmp) / "build", jobs):
+            results["scenarios"][name] = timings
+            print_timings(name, timings)
+    results["peak_rss_mb"] = peak_rss_mb()
+
+    if output is None:
+        output = RESULTS_DIR / f"{datetime.now():%Y-%m-%dT%H-%M-%S}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(results, indent=2))
+    print(f"Peak RSS: {results['peak_rss_mb']:.0f}MB. Results saved to {output}")
+    return output
+
+
+def print_timings(name: str, timings: Dict[str, float]) -> None:
+    phases = ", ".join(f"{p}: {timings.get(p, 0.0):.3f}s" for p in PHASES)
+    print(f"{name:<12} total: {timings['total']:.3f}s ({phases})")
+
+
+def compare(baseline: Path, current: Path, tolerance: float = 0.1) -> None:
+    """Compares two benchmark results, and fails if a phase got slower.
+
+    - tolerance: relative slow down allowed before reporting a regression
+    """
+    old, new = json.loads(baseline.read_text()), json.loads(current.read_text())
+    if old["params"] != new["params"]:
+        print(f"Warning: different parameters {old['params']} != {new['params']}")
+    regressions = []
+    for name, new_timings in new["scenarios"].items():
+        old_timings = old["scenarios"].get(name, {})
+        for phase in PHASES + ["total"]:
+            if phase not in old_timings or phase not in new_timings:
+                continue
+            before, after = old_timings[phase], new_timings[phase]
+            ratio = after / before if before else 1.0
+            print(
+                f"{name:<12} {phase:<10} {before:8.3f}s -> {after:8.3f}s ({ratio:.2f}x)"
+            )
+            if ratio > 1 + tolerance:
+                regressions.append(f"{name}/{phase}")
+    if regressions:
+        raise SystemExit(f"Regressions found: {', '.join(regressions)}")
+
+
+if __name__ == "__main__":
+    func_argparse.main(run, compare, generate)
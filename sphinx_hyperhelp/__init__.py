@@ -1,4 +1,60 @@
-from .__main__ import main
-from .help_builder import HyperHelpBuilder, setup
-from .help_writer import HyperHelpTranslator
-from .hyperhelp import HelpExternal, HelpFile, HelpIndex, HelpTopic
+"""Sphinx builder for HyperHelp, the help system of Sublime Text.
+
+Sphinx is slow to import, so the modules using it are only imported
+when one of their names is accessed. This keeps the command line fast
+for actions that don't build anything, like `--help` or `download`.
+"""
+
+import importlib
+from typing import TYPE_CHECKING, Any
+
+if TYPE_CHECKING:
+    from .__main__ import BuildResult, CacheStats, build_package, main
+    from .help_builder import HyperHelpBuilder, setup
+    from .help_writer import HyperHelpTranslator
+    from .hyperhelp import (
+        ExternalIndex,
+        HelpExternal,
+        HelpFile,
+        HelpIndex,
+        HelpPart,
+        HelpTopic,
+        TopicIndex,
+    )
+    from .translate import Translation, translate_doctree, translate_rst
+
+_LAZY_NAMES = {
+    "BuildResult": "__main__",
+    "CacheStats": "__main__",
+    "build_package": "__main__",
+    "main": "__main__",
+    "HyperHelpBuilder": "help_builder",
+    "setup": "help_builder",
+    "HyperHelpTranslator": "help_writer",
+    "ExternalIndex": "hyperhelp",
+    "HelpExternal": "hyperhelp",
+    "HelpFile": "hyperhelp",
+    "HelpIndex": "hyperhelp",
+    "HelpPart": "hyperhelp",
+    "HelpTopic": "hyperhelp",
+    "TopicIndex": "hyperhelp",
+    "Translation": "translate",
+    "translate_doctree": "translate",
+    "translate_rst": "translate",
+}
+
+__all__ = list(_LAZY_NAMES)
+
+
+def __getattr__(name: str) -> Any:
+    if name not in _LAZY_NAMES:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    module = importlib.import_module(f"{__name__}.{_LAZY_NAMES[name]}")
+    value = getattr(module, name)
+    # Cache it, so __getattr__ is only called once per name.
+    globals()[name] = value
+    return value
+
+
+def __dir__() -> list:
+    return sorted(list(globals()) + __all__)
@@ -1,20 +1,30 @@
 # from __future__ import annotations
 # TODO: func_argparse doesn't work with python 3.10
 
+import hashlib
 import json
 import logging
+import multiprocessing
 import os
 import subprocess
-import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from pathlib import Path
-from typing import Union
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Set, Tuple
 
 import func_argparse
 
+from . import batch
+from .hyperhelp import HelpIndex, Validation
+from .sources import DOC_DIR, checkout
+from .validator import print_validation, validate_package
+from .watcher import SourceWatcher
+
 logger = logging.getLogger("sphinx_hyperhelp")
 
 BUILD_DIR = Path(".") / "build"
 REPOS_DIR = Path(".") / "repos"
+CACHE_DIR = Path(".") / "cache"
 
 # TODO: can we do better to distribute packages ?
 FAMOUS_REPOS = {
@@ -22,6 +32,8 @@ FAMOUS_REPOS = {
     "PythonDocs": ("https://github.com/python/cpython", "v3.8.8"),
     "Sphinx": ("https://github.com/sphinx-doc/sphinx.git", ""),
 }
+# Cloning is mostly waiting for the network, so we use more workers than for builds.
+CLONE_WORKERS = 8
 
 
 def resolve_subl() -> Path:
@@ -32,24 +44,186 @@ def resolve_subl() -> Path:
 
 
 def download(name: str, repo: str = "", tag: str = "") -> Path:
-    srcdir = REPOS_DIR / name
-    REPOS_DIR.mkdir(exist_ok=True)
-
-    if srcdir.exists():
-        return srcdir
+    """Checks out the documentation of the given tag of the repo in repos/NAME.
 
+    See `sources.checkout`, only the missing files are downloaded.
+    """
+    srcdir = REPOS_DIR / name
     if name in FAMOUS_REPOS:
         famous_repo, famous_tag = FAMOUS_REPOS[name]
         repo = repo or famous_repo
         tag = tag or famous_tag
 
-    clone_cmd = ["git", "clone", "--depth=2", repo, str(srcdir)]
-    if tag:
-        clone_cmd.insert(2, f"--branch={tag}")
-    subprocess.run(clone_cmd, check=True)
+    if not repo:
+        # Sources put there by hand.
+        if srcdir.exists():
+            return srcdir
+        raise ValueError(f"Unknown repository for {name}, use --repo")
+
+    REPOS_DIR.mkdir(exist_ok=True)
+    checkout(srcdir, repo, tag)
     return srcdir
 
 
+class CacheStats(NamedTuple):
+    """How many documents were reused from the doctree cache."""
+
+    docs: int
+    # Documents parsed again, because they changed or weren't in the cache.
+    read: int
+
+    @property
+    def hits(self) -> int:
+        return self.docs - self.read
+
+    @property
+    def hit_rate(self) -> float:
+        return self.hits / self.docs if self.docs else 1.0
+
+
+class BuildResult(NamedTuple):
+    help_index: HelpIndex
+    validation: Validation
+    # Exit code of Sphinx, non zero if there were errors.
+    status: int
+    cache: CacheStats = CacheStats(0, 0)
+
+
+def doctree_cache(name: str, srcdir: Path) -> Path:
+    """Cache of the parsed documents of a package, reused by the next builds.
+
+    Sphinx discards the cache when the source folder changes,
+    so there is one cache per package and source folder.
+    Changing the tag of the sources only parses again the modified documents.
+    """
+    key = hashlib.sha1(str(srcdir.resolve()).encode("utf-8")).hexdigest()[:10]
+    return CACHE_DIR / "doctrees" / f"{name}-{key}"
+
+
+def build_package(
+    srcdir: Path,
+    outdir: Path,
+    doctreedir: Path = None,
+    jobs: int = 1,
+    **confoverrides: Any,
+) -> BuildResult:
+    """Builds the HyperHelp files of a Sphinx project, in this process.
+
+    - srcdir: folder containing the `conf.py` of the project
+    - outdir: folder where to write the HyperHelp files
+    - doctreedir: cache of the parsed documents, reused by the next builds.
+      Defaults to `outdir/.doctrees` like `sphinx-build`.
+    - jobs: number of parallel processes used by Sphinx
+    - confoverrides: values overriding the ones from `conf.py`
+    """
+    # Sphinx is slow to import, so it's only imported when we actually build.
+    from sphinx.util.docutils import docutils_namespace, patch_docutils
+
+    # Same isolation than `sphinx-build`, so we can build several projects.
+    with patch_docutils(str(srcdir)), docutils_namespace():
+        app = _make_app(srcdir, outdir, doctreedir, jobs, confoverrides)
+        return _build(app)
+
+
+def _make_app(
+    srcdir: Path,
+    outdir: Path,
+    doctreedir: Optional[Path],
+    jobs: int,
+    confoverrides: Dict[str, Any],
+) -> Any:
+    from sphinx.application import Sphinx
+
+    return Sphinx(
+        str(srcdir),
+        str(srcdir),
+        str(outdir),
+        str(doctreedir or outdir / ".doctrees"),
+        "hyperhelp",
+        confoverrides=confoverrides,
+        parallel=jobs,
+    )
+
+
+def _build(app: Any) -> BuildResult:
+    """Builds the outdated documents, the app can be reused for the next builds."""
+    read: List[str] = []
+    listener = app.connect(
+        "env-before-read-docs", lambda app, env, docs: read.extend(docs)
+    )
+    try:
+        app.build()
+    finally:
+        app.disconnect(listener)
+    state = app.builder.state
+    cache = CacheStats(len(app.env.found_docs), len(read))
+    # finish always validates the index, even when nothing was written.
+    assert state.validation is not None
+    return BuildResult(state.index, state.validation, app.statuscode, cache)
+
+
+def watch_package(
+    srcdir: Path,
+    outdir: Path,
+    doctreedir: Path = None,
+    on_build: Callable[[BuildResult, Set[str], float], None] = None,
+    max_builds: int = 0,
+    poll: float = 0.1,
+    debounce: float = 0.2,
+    jobs: int = 1,
+    **confoverrides: Any,
+) -> None:
+    """Builds a Sphinx project, and builds it again each time its sources change.
+
+    The same Sphinx application is used for all the builds,
+    so only the modified documents are read and written again.
+
+    - on_build: called after each build, with the result, the modified files
+      and the duration of the build
+    - max_builds: stop after this number of builds, 0 to watch until interrupted.
+      Failed builds are counted too.
+    - poll, debounce: see `SourceWatcher.wait`
+    Other arguments are the same than for `build_package`.
+
+    Errors don't stop watching, they are logged and the next change is built again.
+    An invalid `conf.py` is logged, and the previous configuration is used.
+    """
+    from sphinx.util.docutils import docutils_namespace, patch_docutils
+
+    ignore = [outdir, doctreedir or outdir / ".doctrees"]
+    watcher = SourceWatcher(srcdir, ignore)
+    with patch_docutils(str(srcdir)), docutils_namespace():
+        app = _make_app(srcdir, outdir, doctreedir, jobs, confoverrides)
+        changed: Set[str] = set()
+        # The configuration is only read when creating the app.
+        # It's created again after a failed build, that may have left it inconsistent.
+        reload_app = False
+        builds = 0
+        while True:
+            start = time.perf_counter()
+            if reload_app or "conf.py" in changed:
+                try:
+                    app = _make_app(srcdir, outdir, doctreedir, jobs, confoverrides)
+                    reload_app = False
+                except Exception:
+                    logger.exception(
+                        f"Invalid configuration in {srcdir}, keeping the previous one"
+                    )
+                    reload_app = True
+            try:
+                result = _build(app)
+            except Exception:
+                logger.exception(f"Failed to build {srcdir}, waiting for changes")
+                reload_app = True
+            else:
+                if on_build:
+                    on_build(result, changed, time.perf_counter() - start)
+            builds += 1
+            if builds == max_builds:
+                return
+            changed = watcher.wait(poll, debounce)
+
+
 def build(name: str, repo: str = "", tag: str = "", outdir: Path = None) -> Path:
     """Builds a Sphinx projects documentation into a Sublime Text package.
 
@@ -59,20 +233,61 @@ def build(name: str, repo: str = "", tag: str = "", outdir: Path = None) -> Path
     - tag: specific git tag/branch/commit to fetch. Defaults to the `master` branch of the repo.
     """
     srcdir = download(name, repo, tag)
-    docdir = srcdir / "doc"
+    docdir = srcdir / DOC_DIR
     assert docdir.exists(), f"No documentation folder found at {docdir}"
     outdir = outdir or BUILD_DIR / name
 
-    sphinx_cmd: list[Union[str, Path]] = [sys.executable, "-m", "sphinx", "-P"]
-    sphinx_cmd += ["-b=hyperhelp", srcdir / "doc", outdir / "hyperhelp"]
-    subprocess.run(sphinx_cmd, check=True)
+    doctreedir = doctree_cache(name, docdir)
+    result = build_package(docdir, outdir / "hyperhelp", doctreedir)
+    if result.status != 0:
+        raise Exception(f"Sphinx failed to build the documentation of {name}")
+    cache = result.cache
+    print(
+        f"{name}: reused {cache.hits}/{cache.docs} parsed documents "
+        f"({cache.hit_rate:.0%}) from {doctreedir}"
+    )
     logger.info(f"Build Package {name} to {outdir}")
 
     return outdir
 
 
+def watch(name: str, repo: str = "", tag: str = "", outdir: Path = None) -> None:
+    """Builds the package each time its sources change, and reloads it in Sublime Text.
+
+    Stop it with Ctrl+C.
+    """
+    srcdir = download(name, repo, tag)
+    docdir = srcdir / DOC_DIR
+    assert docdir.exists(), f"No documentation folder found at {docdir}"
+    outdir = outdir or BUILD_DIR / name
+
+    def reload(result: BuildResult, changed: Set[str], duration: float) -> None:
+        start = time.perf_counter()
+        _run_subl_command("hyperhelp_author_reload_index_by_name", package=name)
+        duration += time.perf_counter() - start
+        print(
+            f"{name}: {len(changed)} files changed, {result.cache.read} documents "
+            f"read again, built and reloaded in {duration:.2f}s"
+        )
+
+    print(f"Watching {docdir}, press Ctrl+C to stop.")
+    try:
+        watch_package(
+            docdir,
+            outdir / "hyperhelp",
+            doctree_cache(name, docdir),
+            on_build=reload,
+        )
+    except KeyboardInterrupt:
+        pass
+
+
 def install(name: str, repo: str = "", tag: str = "", outdir: Path = None) -> Path:
     outdir = build(name, repo, tag, outdir)
+    return _install_package(name, outdir)
+
+
+def _install_package(name: str, outdir: Path) -> Path:
     package_dir = resolve_subl() / name
     if package_dir.exists():
         if package_dir.resolve() != outdir.resolve():
@@ -89,32 +304,175 @@ def install(name: str, repo: str = "", tag: str = "", outdir: Path = None) -> Pa
     return package_dir
 
 
+def validate(outdir: Path, jobs: int = None) -> bool:
+    """Checks the links of a package built in outdir, without running Sphinx."""
+    package_dir = outdir / "hyperhelp"
+    validation = validate_package(package_dir, jobs)
+    print_validation(package_dir, validation)
+    return validation.valid
+
+
 def _run_subl_command(command, **args):
     subprocess.run(["subl", "--command", " ".join((command, json.dumps(args)))])
 
 
+class PackageResult(NamedTuple):
+    name: str
+    # Empty if the package was successfully processed
+    error: str
+    download: float
+    build: float
+
+
+def load_packages(manifest: Path) -> Dict[str, Tuple[str, str]]:
+    """Reads a json manifest: {"name": {"repo": "https://...", "tag": "v1.0"}, ...}
+
+    "repo" and "tag" can be omitted for the packages listed in FAMOUS_REPOS.
+    """
+    packages = json.loads(manifest.read_text())
+    return {
+        name: (package.get("repo", ""), package.get("tag", ""))
+        for name, package in packages.items()
+    }
+
+
+def process_packages(
+    packages: Dict[str, Tuple[str, str]],
+    action: str = "build",
+    outdir: Path = None,
+    jobs: int = 2,
+) -> List[PackageResult]:
+    """Downloads, builds and installs several packages concurrently.
+
+    Repositories are cloned in threads, and each package is built in its own
+    process as soon as its repository is ready, with at most `jobs` builds at once.
+    Installing talks to Sublime Text, so it's done sequentially at the end.
+    A package failing, even by crashing its worker, doesn't stop the others.
+    """
+    downloads: Dict[str, float] = {}
+    builds: Dict[str, float] = {}
+    outdirs: Dict[str, Path] = {}
+    errors: Dict[str, str] = {}
+    # Sphinx isn't fork safe when other threads are running, so we use "spawn".
+    mp_context = multiprocessing.get_context("spawn")
+    with ThreadPoolExecutor(CLONE_WORKERS) as clone_pool, ProcessPoolExecutor(
+        jobs, mp_context=mp_context
+    ) as build_pool:
+        clones = {
+            clone_pool.submit(batch.timed, download, name, repo, tag): name
+            for name, (repo, tag) in packages.items()
+        }
+        pending_builds = {}
+        for clone in as_completed(clones):
+            name = clones[clone]
+            try:
+                _, downloads[name], errors[name] = clone.result()
+            except Exception as e:
+                downloads[name], errors[name] = 0.0, batch.error_message(e)
+            if errors[name] or action == "download":
+                continue
+            repo, tag = packages[name]
+            package_outdir = outdir / name if outdir else None
+            args = (name, repo, tag, package_outdir)
+            pending_builds[build_pool.submit(batch.timed, batch.build, *args)] = name
+
+        for future in as_completed(pending_builds):
+            name = pending_builds[future]
+            try:
+                outdirs[name], builds[name], errors[name] = future.result()
+            except Exception as e:
+                # eg BrokenProcessPool, when a worker crashed.
+                errors[name] = batch.error_message(e)
+
+    for name in packages:
+        if action == "install" and not errors[name]:
+            _, _, errors[name] = batch.timed(_install_package, name, outdirs[name])
+
+    return [
+        PackageResult(name, errors[name], downloads[name], builds.get(name, 0.0))
+        for name in packages
+    ]
+
+
+def print_summary(results: List[PackageResult]) -> None:
+    width = max([len("package")] + [len(r.name) for r in results])
+    print(f"{'package':<{width}}  status  download     build")
+    for r in results:
+        status = "failed" if r.error else "ok"
+        print(f"{r.name:<{width}}  {status:<6}  {r.download:7.1f}s  {r.build:7.1f}s")
+    for r in results:
+        if r.error:
+            print(f"{r.name} failed: {r.error}")
+
+
 def _dispatch(
-    name: str,
+    name: str = "",
     repo: str = "",
     tag: str = "",
     outdir: Path = None,
     action: str = "install",
+    manifest: Path = None,
+    famous: bool = False,
+    jobs: int = 2,
 ) -> None:
     """Builds a Sphinx projects documentation and install it as a Sublime Text package.
 
-    - name: name of the output ST package
+    - name: name of the output ST package. Use "A,B" to process several packages.
       Be careful to not create conflicts with other packages
     - repo: git repository of the project to build documentation from
     - tag: specific git tag/branch/commit to fetch. Defaults to the `master` branch of the repo.
-    - outdir: folder where to generate the documentation
-    - action: install/build/download
+    - outdir: folder where to generate the documentation.
+      When processing several packages, each one goes to a subfolder.
+    - action: install/build/download/validate/watch.
+      validate checks the links of a package previously built in outdir.
+      watch builds the package again each time its sources change.
+    - manifest: json file listing packages to process, see `load_packages`
+    - famous: process all the packages from FAMOUS_REPOS
+    - jobs: maximum number of packages built concurrently.
+      With validate, number of processes scanning the help files of each package.
     """
-    actions = {fn.__name__: fn for fn in [install, build, download]}
+    actions = {fn.__name__: fn for fn in [install, build, download, validate, watch]}
     if action not in actions:
         raise ValueError(f"Unknown action {action!r}, chose from {set(actions.keys())}")
 
-    actions[action](name, repo, tag, outdir)  # type: ignore
+    names = [n for n in name.split(",") if n]
+    if len(names) == 1 and not manifest and not famous:
+        if action == "download":
+            download(names[0], repo, tag)
+        elif action == "validate":
+            if not validate(outdir or BUILD_DIR / names[0], jobs):
+                raise SystemExit(1)
+        else:
+            actions[action](names[0], repo, tag, outdir)  # type: ignore
+        return
+
+    if repo or tag:
+        raise ValueError("--repo and --tag can only be used with a single package")
+    if action == "watch":
+        raise ValueError("Only a single package can be watched")
+    packages = {n: ("", "") for n in names}
+    if famous:
+        packages.update({n: ("", "") for n in FAMOUS_REPOS})
+    if manifest:
+        packages.update(load_packages(manifest))
+    if not packages:
+        raise ValueError("Nothing to do, use --name, --manifest or --famous")
+
+    if action == "validate":
+        outdirs = [(outdir or BUILD_DIR) / n for n in packages]
+        if not all([validate(o, jobs) for o in outdirs]):
+            raise SystemExit(1)
+        return
+
+    results = process_packages(packages, action, outdir, jobs)
+    print_summary(results)
+    if any(r.error for r in results):
+        raise SystemExit(1)
 
 
 def main():
     func_argparse.single_main(_dispatch)
+
+
+if __name__ == "__main__":
+    main()
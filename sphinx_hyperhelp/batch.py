@@ -0,0 +1,33 @@
+"""Functions run by the worker processes of `process_packages`.
+
+The functions of `sphinx_hyperhelp.__main__` can't be sent to "spawn"
+processes when running `python -m sphinx_hyperhelp`: the module is then
+named `__main__`, and the workers don't import it again.
+"""
+
+from __future__ import annotations
+
+import time
+from pathlib import Path
+from typing import Any, Callable
+
+
+def error_message(e: BaseException) -> str:
+    return f"{type(e).__name__}: {e}"
+
+
+def timed(fn: Callable, *args: Any) -> tuple[Any, float, str]:
+    """Calls fn, and returns its result, its duration and the error if it failed."""
+    start = time.perf_counter()
+    try:
+        result, error = fn(*args), ""
+    except Exception as e:
+        result, error = None, error_message(e)
+    return result, time.perf_counter() - start, error
+
+
+def build(name: str, repo: str, tag: str, outdir: Path | None) -> Path:
+    """Same as `sphinx_hyperhelp.__main__.build`, in a worker process."""
+    from . import __main__
+
+    return __main__.build(name, repo, tag, outdir)
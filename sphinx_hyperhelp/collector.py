@@ -0,0 +1,227 @@
+from __future__ import annotations
+
+from typing import Any
+
+from docutils import nodes
+from docutils.nodes import Element, Node
+from sphinx.application import Sphinx
+from sphinx.environment import BuildEnvironment
+from sphinx.environment.collectors import EnvironmentCollector
+from sphinx.transforms import SphinxTransform, SphinxTransformer
+from sphinx.transforms.post_transforms import ReferencesResolver
+from sphinx.util import logging
+from sphinx.util.docutils import new_document
+
+from .help_writer import (
+    add_title_topic,
+    is_internal_reference,
+    make_external,
+    mark_isolated_targets,
+    reference_topic,
+    signature_topic,
+    target_topic,
+)
+from .hyperhelp import HelpDocument, TopicIndex, help_target
+
+
+def help_documents(env: BuildEnvironment) -> dict[str, HelpDocument]:
+    """Topics and links of each document, stored in the environment.
+
+    Filled while reading the documents, and updated when writing them.
+    """
+    if not hasattr(env, "hyperhelp_documents"):
+        env.hyperhelp_documents = {}  # type: ignore
+    return env.hyperhelp_documents  # type: ignore
+
+
+def pending_xrefs(env: BuildEnvironment) -> dict[str, list[Element]]:
+    """Cross references that can only be resolved once all documents are read."""
+    if not hasattr(env, "hyperhelp_pending_xrefs"):
+        env.hyperhelp_pending_xrefs = {}  # type: ignore
+    return env.hyperhelp_pending_xrefs  # type: ignore
+
+
+class IsolatedTargets(SphinxTransform):
+    """Marks the isolated targets, that need their own anchor.
+
+    It runs once, when the document is read, just before the collector,
+    and the marks are kept in the cached doctree.
+    It runs whatever the builder, like the collector.
+    """
+
+    # Before DoctreeReadEvent, that calls HyperHelpCollector.
+    default_priority = 870
+
+    def apply(self, **kwargs: Any) -> None:
+        mark_isolated_targets(self.document)
+
+
+class TopicCollector(nodes.SparseNodeVisitor):
+    """Finds the topics and links of a doctree, the same way HyperHelpTranslator does.
+
+    Unresolved cross references are kept aside in `pending_xrefs`.
+    """
+
+    def __init__(self, document: nodes.document, doc: HelpDocument):
+        super().__init__(document)
+        self.doc = doc
+        self.pending_xrefs: list[Element] = []
+
+    def unknown_visit(self, node: Node) -> None:
+        pass
+
+    def skip(self, node: Node) -> None:
+        raise nodes.SkipNode
+
+    # Those nodes are skipped by the TextTranslator
+    visit_comment = skip
+    visit_raw = skip
+    visit_substitution_definition = skip
+    visit_system_message = skip
+    visit_toctree = skip
+    visit_acks = skip
+    visit_number_reference = skip
+
+    def visit_title(self, node: Element) -> None:
+        if isinstance(node.parent, nodes.Admonition):
+            raise nodes.SkipNode
+        add_title_topic(self.doc, node)
+
+    def visit_desc_signature(self, node: Element) -> None:
+        topic = signature_topic(node)
+        if topic:
+            self.doc.add_topic(topic)
+
+    visit_term = visit_desc_signature
+    visit_definition_list = visit_desc_signature
+
+    def visit_target(self, node: Element) -> None:
+        topic = target_topic(node)
+        if topic:
+            self.doc.add_topic(topic)
+
+    def visit_reference(self, node: Element) -> None:
+        if is_internal_reference(node):
+            topic = reference_topic(node)
+            if topic:
+                self.doc.add_link(topic)
+        else:
+            external = make_external(node.get("refuri"))
+            topic = external.topic if external else None
+            if external:
+                self.doc.add_external(external)
+        if topic:
+            raise nodes.SkipNode
+
+    def visit_pending_xref(self, node: Element) -> None:
+        self.pending_xrefs.append(node.deepcopy())
+        raise nodes.SkipNode
+
+
+class HyperHelpCollector(EnvironmentCollector):
+    """Collects the topics and links of each document while Sphinx reads them.
+
+    This allows to validate and prune the index without looking at
+    the documents that don't need to be written again.
+    """
+
+    def clear_doc(self, app: Sphinx, env: BuildEnvironment, docname: str) -> None:
+        help_documents(env).pop(docname, None)
+        pending_xrefs(env).pop(docname, None)
+
+    def merge_other(
+        self,
+        app: Sphinx,
+        env: BuildEnvironment,
+        docnames: set[str],
+        other: BuildEnvironment,
+    ) -> None:
+        documents, other_documents = help_documents(env), help_documents(other)
+        xrefs, other_xrefs = pending_xrefs(env), pending_xrefs(other)
+        for docname in docnames:
+            if docname in other_documents:
+                documents[docname] = other_documents[docname]
+            if docname in other_xrefs:
+                xrefs[docname] = other_xrefs[docname]
+
+    def process_doc(self, app: Sphinx, doctree: nodes.document) -> None:
+        # Collected whatever the builder, because documents read by another
+        # builder sharing the doctrees folder won't be read again.
+        env = app.env
+        docname = env.docname
+        doc = HelpDocument(docname, help_target(docname))
+        collector = TopicCollector(doctree, doc)
+        doctree.walk(collector)
+        help_documents(env)[docname] = doc
+        if collector.pending_xrefs:
+            pending_xrefs(env)[docname] = collector.pending_xrefs
+
+    def get_updated_docs(self, app: Sphinx, env: BuildEnvironment) -> list[str]:
+        """Resolves the cross references, now that all documents have been read.
+
+        Returns the unchanged documents that need to be written again,
+        because their ambiguous topics changed since the previous build.
+        """
+        xrefs = pending_xrefs(env)
+        documents = help_documents(env)
+        # Warnings for broken references will be emitted when writing the docs.
+        with logging.suppress_logging():
+            for docname, doc_xrefs in xrefs.items():
+                if docname in documents:
+                    resolve_xrefs(env, docname, doc_xrefs, documents[docname])
+        xrefs.clear()
+        if app.builder.name != "hyperhelp":
+            return []
+        # Documents are written after the environment is pickled,
+        # so we compare with the index of the previous build, not with the env.
+        cached_index = app.builder.cached_index  # type: ignore
+        if cached_index is None:
+            return []
+
+        previous_index = TopicIndex()
+        for target, help_file in cached_index.help_files.items():
+            previous_index.add_file(target, help_file)
+        docnames = sorted(d for d in env.found_docs if d in documents)
+        topic_index = TopicIndex.from_documents(documents[d] for d in docnames)
+
+        def changed(doc: HelpDocument) -> bool:
+            previous = cached_index.help_files.get(doc.target)
+            if previous is None:
+                return False
+            return topic_index.ambiguities(
+                doc.target, doc.help_file
+            ) != previous_index.ambiguities(doc.target, previous)
+
+        return [d for d in docnames if changed(documents[d])]
+
+
+def resolve_xrefs(
+    env: BuildEnvironment, docname: str, xrefs: list[Element], doc: HelpDocument
+) -> None:
+    """Resolves the given cross references and registers the links they point to.
+
+    Only the cross references are resolved, not the full doctree.
+    """
+    document = new_document(env.doc2path(docname))
+    document += nodes.paragraph("", "", *xrefs)
+    backup = env.temp_data.copy()
+    try:
+        env.temp_data["docname"] = docname
+        transformer = SphinxTransformer(document)
+        transformer.set_environment(env)
+        transformer.add_transform(ReferencesResolver)
+        transformer.apply_transforms()
+    finally:
+        env.temp_data = backup
+    document.walk(TopicCollector(document, doc))
+    release_document(document)
+
+
+def release_document(document: nodes.document) -> None:
+    """Detaches a document created by `sphinx.util.docutils.new_document`.
+
+    Those documents share the same reporter, that keeps a reference
+    to each of them, and so to the environment in their settings.
+    Without this, every build would stay in memory until the process exits.
+    """
+    document.reporter.detach_observer(document.note_transform_message)
@@ -1,24 +1,91 @@
 from __future__ import annotations
 
-from collections import defaultdict
+import contextlib
+import cProfile
+import json
+import os
+import subprocess
+import sys
+import time
+from datetime import date
 from pathlib import Path
-from typing import Any, Dict, Iterator, Set, Tuple
+from typing import (
+    Any,
+    ContextManager,
+    Dict,
+    Iterable,
+    Iterator,
+    NamedTuple,
+    Sequence,
+    Set,
+    Tuple,
+    cast,
+)
 
+from docutils import nodes
 from docutils.io import StringOutput
-from docutils.nodes import Node
 from sphinx.application import Sphinx
 from sphinx.builders import Builder
 from sphinx.builders.text import TextBuilder
+from sphinx.config import ENUM
 from sphinx.locale import __
-from sphinx.util import logging
+from sphinx.util import logging, status_iterator
+from sphinx.util.build_phase import BuildPhase
+from sphinx.util.console import bold  # type: ignore
 from sphinx.util.osutil import ensuredir, os_path
+from sphinx.util.parallel import ParallelTasks, make_chunks
 
+from .collector import HyperHelpCollector, IsolatedTargets, help_documents
 from .help_writer import HyperHelpTranslator, HyperHelpWriter
-from .hyperhelp import HelpFile, HelpIndex, HelpTopic
+from .hyperhelp import (
+    ExternalIndex,
+    HelpDocument,
+    HelpExternal,
+    HelpFile,
+    HelpIndex,
+    HelpPart,
+    TopicIndex,
+    Validation,
+    digest,
+    help_target,
+    write_if_changed,
+)
+from .stats import BuildStats, DocStats
 
 logger = logging.getLogger(__name__)
 
 
+class BuildState:
+    """What the builder computes during one build, from prepare_writing to finish.
+
+    Each build creates a new state, so nothing accumulates in a process
+    running many builds. Only the caches of the builder (cached_index,
+    manifest and parts) are carried over to the next build.
+    """
+
+    def __init__(
+        self,
+        index: HelpIndex,
+        topic_index: TopicIndex,
+        offsets: dict[str, dict[str, tuple[int, int]]],
+        git_dates: dict[str, date],
+        stats: BuildStats | None,
+    ):
+        self.index = index
+        # Topics collected while reading, used to disambiguate anchors and links.
+        self.topic_index = topic_index
+        # Position of the anchors in each help file, see `save_offsets`.
+        self.offsets = offsets
+        self.git_dates = git_dates
+        # Only set when hyperhelp_profile is enabled.
+        self.stats = stats
+        # Topics linked, and the first document linking them. Set by finish.
+        self.links: dict[str, str] = {}
+        # References to the external links. Set by finish.
+        self.externals = ExternalIndex()
+        self.validation: Validation | None = None
+
+
 class HyperHelpBuilder(TextBuilder):
     name = "hyperhelp"
     format = "text"
@@ -31,32 +98,210 @@ class HyperHelpBuilder(TextBuilder):
     default_translator_class = HyperHelpTranslator  # type: ignore
 
     current_docname: str = ""
-    current_helpfile: HelpFile = None  # type: ignore
-    index: HelpIndex = None  # type: ignore
-    links: dict[str, str] = {}
     _translator: HyperHelpTranslator = None  # type: ignore
-    _resolved_topics: dict[str, str] = {}  # uri to file
+    _doctree: nodes.document = None  # type: ignore
+    # Set by prepare_writing
+    writer: HyperHelpWriter
+
+    def init(self) -> None:
+        super().init()
+        # Index of the previous build, before pruning.
+        # It's used to only rewrite outdated documents.
+        self.cached_index = self.load_cached_index()
+        # Hash of each help file, used to not rewrite unchanged files.
+        self.manifest: dict[str, str] = self.load_manifest()
+        # Files written for the documents split by sections, see hyperhelp_max_file_size
+        self.parts: dict[str, list[HelpPart]] = self.load_cached_parts()
+        self._state: BuildState | None = None
+
+    def build(
+        self, docnames: Iterable[str], summary: str = None, method: str = "update"
+    ) -> None:
+        self._state = None
+        super().build(docnames, summary, method)
+        if self._state is None:
+            # Sphinx skips writing when nothing is out of date,
+            # the index is rebuilt from the previous build, without writing any file.
+            self.prepare_writing(set())
+            self.finish()
+
+    @property
+    def state(self) -> BuildState:
+        """State of the current build, or of the last one once it's finished."""
+        assert self._state is not None, "prepare_writing wasn't called"
+        return self._state
+
+    @property
+    def topic_index(self) -> TopicIndex | None:
+        return self._state.topic_index if self._state else None
+
+    def cache_path(self, name: str) -> Path:
+        return Path(self.doctreedir) / name
+
+    def load_cached_index(self) -> HelpIndex | None:
+        cache = self.cache_path("hyperhelp.json")
+        if not cache.exists():
+            return None
+        try:
+            return HelpIndex.load(cache)
+        except (ValueError, KeyError, TypeError) as e:
+            logger.warning(f"Ignoring invalid cached index {cache}: {e}")
+            return None
+
+    def load_cached_parts(self) -> dict[str, list[HelpPart]]:
+        cache = self.cache_path("hyperhelp_parts.json")
+        if not cache.exists():
+            return {}
+        try:
+            parts = json.loads(cache.read_text())
+            return {t: [HelpPart.from_json(p) for p in ps] for t, ps in parts.items()}
+        except (ValueError, TypeError) as e:
+            logger.warning(f"Ignoring invalid cached parts {cache}: {e}")
+            return {}
+
+    def manifest_path(self) -> Path:
+        return Path(self.outdir) / "hyperhelp_manifest.json"
+
+    def load_manifest(self) -> dict[str, str]:
+        manifest = self.manifest_path()
+        if not manifest.exists():
+            return {}
+        try:
+            return json.loads(manifest.read_text())
+        except ValueError as e:
+            logger.warning(f"Ignoring invalid manifest {manifest}: {e}")
+            return {}
+
+    def save_manifest(self) -> None:
+        manifest = {
+            t: self.manifest[t]
+            for t in self.state.index.help_files
+            if t in self.manifest
+        }
+        self.manifest = manifest
+        write_if_changed(self.manifest_path(), json.dumps(manifest, indent=2))
+
+    def offsets_path(self) -> Path:
+        return Path(self.outdir) / "hyperhelp_offsets.json"
+
+    def load_offsets(self) -> dict[str, dict[str, tuple[int, int]]]:
+        offsets = self.offsets_path()
+        if not offsets.exists():
+            return {}
+        try:
+            return json.loads(offsets.read_text())
+        except ValueError as e:
+            logger.warning(f"Ignoring invalid offsets {offsets}: {e}")
+            return {}
+
+    def save_offsets(self) -> None:
+        """Writes the (line, byte offset) of the anchors of each help file.
+
+        This allows readers to jump to a topic without searching the file.
+        Lines start at 0, offsets are counted in bytes from the start of the file.
+        """
+        state = self.state
+        targets = (target for target, _, _ in state.index.files())
+        offsets = {t: state.offsets[t] for t in targets if t in state.offsets}
+        state.offsets = offsets
+        content = json.dumps(offsets, ensure_ascii=False, separators=(",", ":"))
+        write_if_changed(self.offsets_path(), content)
+
+    def save_cache(self) -> None:
+        self.cached_index = index = self.state.index
+        index.save(self.cache_path("hyperhelp.json"), compact=True)
+        parts = {
+            t: [p.as_json() for p in self.parts[t]]
+            for t in index.help_files
+            if t in self.parts
+        }
+        write_if_changed(self.cache_path("hyperhelp_parts.json"), json.dumps(parts))
 
     def prepare_writing(self, docnames):
         self.writer = HyperHelpWriter(self)
         config = self.config
+        # Done once here, instead of in each parallel writer.
+        dates = git_dates(Path(self.srcdir)) if config.hyperhelp_date == "git" else {}
         description = config.epub_description or config.html_title
         # print(
         #     {k: v[0] for k, v in config.values.items() if not callable(v[0]) and v[0]}
         # )
-        self.index = HelpIndex(config.project, description, Path(self.outdir))
-        self.links = {}
+
+        # Keep the help files of the documents that won't be rewritten.
+        def unchanged(docname: str) -> bool:
+            return docname in self.env.found_docs and docname not in docnames
+
+        help_files: dict[str, HelpFile] = {}
+        externals: dict[str, HelpExternal] = {}
+        if self.cached_index is not None:
+            for target, help_file in self.cached_index.help_files.items():
+                if unchanged(self.get_docname(target)):
+                    help_files[target] = help_file
+            externals.update(self.cached_index.externals)
+        # The parts of the rewritten documents are kept until they are merged,
+        # to remove the part files they don't write anymore.
+        self.parts = {
+            t: parts
+            for t, parts in self.parts.items()
+            if self.get_docname(t) in self.env.found_docs
+        }
+        previous_offsets = self.load_offsets()
+        targets = list(help_files)
+        targets += [p.target for t in help_files for p in self.parts.get(t, [])]
+        offsets = {t: previous_offsets[t] for t in targets if t in previous_offsets}
+        index = HelpIndex(
+            config.project, description, Path(self.outdir), help_files, externals
+        )
+        stats = None
+        if config.hyperhelp_profile:
+            stats = BuildStats(top=config.hyperhelp_profile_top)
+        self._state = BuildState(
+            index, TopicIndex.from_documents(self.documents()), offsets, dates, stats
+        )
         # TODO: StandaloneHTMLBuilder creates an index page for each html_domain_indices.
         # See eg: https://www.sphinx-doc.org/en/master/py-modindex.html
         # I think we should add this to HyperHelp.
 
-    # TODO: edit reload existing index, and override get_outdated_docs
-    # to keep unchanged files in the index
     def get_outdated_docs(self) -> Iterator[str]:
-        yield from self.env.found_docs
+        """Yields the documents that need to be written again.
+
+        Modified documents are re-read by Sphinx and are always written again.
+        Here we only look for the documents missing from the previous build.
+        We can't rely on the modification time of the output file,
+        because unchanged files aren't rewritten.
+        """
+        cached_files = self.cached_index.help_files if self.cached_index else {}
+        outdir = Path(self.outdir)
+        for docname in self.env.found_docs:
+            target = self.get_target_uri(docname)
+            if (
+                docname not in self.env.all_docs
+                or target not in cached_files
+                or target not in self.manifest
+                or not (outdir / target).exists()
+            ):
+                yield docname
+
+    def get_doc_date(self, docname: str) -> date:
+        """Date of the document, written in the help file header.
+
+        Using the date of the build would modify all files on each build.
+        """
+        source = self.env.doc2path(docname)
+        dates = self._state.git_dates if self._state else {}
+        if source in dates:
+            return dates[source]
+        return date.fromtimestamp(os.path.getmtime(source))
 
     def get_target_uri(self, docname: str, typ: str = None) -> str:
-        return docname + ".txt"
+        return help_target(docname)
+
+    def get_part_uri(self, docname: str, n: int) -> str:
+        """Target of the n-th file of a document split by sections."""
+        return f"{docname}.{n}{self.out_suffix}"
+
+    def get_docname(self, target: str) -> str:
+        return target[: -len(self.out_suffix)]
 
     def get_relative_uri(self, from_: str, to: str, typ: str = None) -> str:
         # ignore source path, Hyperhelp only has absolute paths
@@ -64,107 +309,322 @@ class HyperHelpBuilder(TextBuilder):
         return self.get_target_uri(to, typ)
 
     def finish(self) -> None:
+        # Restore the reading order, rewritten files have been appended at the end.
+        state = self.state
+        help_files = state.index.help_files
+        targets = [self.get_target_uri(d) for d in sorted(self.env.found_docs)]
+        state.index = state.index._replace(
+            help_files={t: help_files[t] for t in targets if t in help_files}
+        )
+        documents = self.documents()
+        state.topic_index = topic_index = TopicIndex.from_documents(documents)
+        state.links = {
+            topic_index.link(doc.target, topic): doc.docname
+            for doc in documents
+            for topic in sorted(doc.links)
+        }
+        state.externals = ExternalIndex.from_documents(documents)
+        # Forget the externals only linked by deleted or modified documents,
+        # unless a document wasn't collected and may still link them.
+        if len(documents) == len(self.env.found_docs):
+            state.index = state.index._replace(
+                externals=state.externals.prune(state.index.externals)
+            )
+        if state.stats is not None:
+            state.stats.externals = state.externals.refcounts
+        self.save_cache()
+        self.save_manifest()
+
+        with self.phase("validate"):
+            state.validation = validation = self.validate()
+        state.index = state.index._replace(owners=state.topic_index, parts=self.parts)
+        self.save_offsets()
         if self.config.hyperhelp_prune_topics:
-            self.index = self.index.prune(set(self.links.keys()))
-        valid = self.validate()
-        self.index.save()
-        if not valid:
+            with self.phase("prune"):
+                state.index = state.index.prune(state.topic_index)
+        with self.phase("save"):
+            self.save_index()
+        if state.stats is not None:
+            output = state.stats.save(Path(self.outdir))
+            logger.info(f"Saved build statistics to {output}")
+        if not validation.valid:
             logger.error("The index seems invalid, some topics may be missing")
 
-    def validate(self) -> bool:
-        all_topics = [
-            (file, help_topic)
-            for file, hf in self.index.help_files.items()
-            for help_topic in hf.topics
-        ]
-        resolved_topics: dict[str, str] = {}
-        # files are they own topics
-        for file in self.index.help_files.keys():
-            resolved_topics[file] = file
-
-        conflicts_set: dict[str, set[str]] = defaultdict(set)
-        for file, help_topic in all_topics:
-            topic = help_topic.topic
-            conflict = resolved_topics.get(topic)
-            if conflict:
-                conflicts_set[topic].add(conflict)
-                conflicts_set[topic].add(file)
-
-            resolved_topics[topic] = file
-            for alias in help_topic.aliases:
-                resolved_topics[alias] = file
+    def phase(self, name: str) -> ContextManager:
+        """Times the given phase of the build, when hyperhelp_profile is enabled."""
+        if self._state is None or self._state.stats is None:
+            return contextlib.nullcontext()
+        return self._state.stats.phase(name)
+
+    def documents(self) -> list[HelpDocument]:
+        """Topics and links of all documents, as collected in the environment."""
+        documents = help_documents(self.env)
+        return [documents[d] for d in sorted(self.env.found_docs) if d in documents]
+
+    def save_index(self) -> Path:
+        start = time.perf_counter()
+        output = self.state.index.save(compact=self.config.hyperhelp_compact_index)
+        duration = time.perf_counter() - start
+        rss = peak_rss_mb()
+        logger.info(
+            f"Saved index {output} in {duration:.2f}s"
+            + (f" (peak RSS: {rss:.0f}MB)" if rss else "")
+        )
+        return output
 
+    def validate(self) -> Validation:
+        """Checks that all links point to exactly one topic."""
+        state = self.state
+        topic_index = state.topic_index
         conflicts = []
         unresolveds = []
-        for topic, file in self.links.items():
-            if topic not in resolved_topics:
+        for topic, file in state.links.items():
+            if topic_index.resolve(topic) is None:
                 logger.warning(f"Unresolved topic: {topic} in file {file}")
                 unresolveds.append(f"{topic} ({file})")
 
-            if topic in conflicts_set:
-                conflicting = conflicts_set[topic]
+            if topic in topic_index.conflicts:
+                conflicting = sorted(topic_index.conflicts[topic])
                 logger.warning(
                     f"In file {file}, topic #{topic} is ambiguous among those files: {', '.join(conflicting)}"
                 )
                 conflicts.append(f"{file}#{topic} - {', '.join(conflicting)}")
 
-        (Path(self.outdir) / "unresolved.txt").write_text("\n".join(unresolveds))
-        (Path(self.outdir) / "conflicts.txt").write_text("\n".join(conflicts))
+        write_if_changed(Path(self.outdir) / "unresolved.txt", "\n".join(unresolveds))
+        write_if_changed(Path(self.outdir) / "conflicts.txt", "\n".join(conflicts))
 
-        total_links = len(self.links)
-        valid = True
+        total_links = len(state.links)
         if len(unresolveds) > 0:
             logger.error(f"Found {len(unresolveds)} / {total_links} unresolved topics")
-            valid = False
 
         if len(conflicts) > 0:
             logger.error(f"Found {len(conflicts)} / {total_links} ambiguous topics")
-            valid = False
 
         # TODO: also validate the index:
         # https://github.com/STealthy-and-haSTy/hyperhelpcore/blob/master/all/hyperhelpcore/index_validator.py
         # Notably we should remove aliases that aren't used in practices.
-        return valid
+        return Validation(total_links, unresolveds, conflicts)
+
+    def write_doc(self, docname: str, doctree: nodes.Node) -> None:
+        # Sphinx always writes documents, but declares a Node.
+        doctree = cast(nodes.document, doctree)
+        self.merge_document(*self.profile_doc(docname, doctree))
+
+    def profile_doc(
+        self, docname: str, doctree: nodes.document
+    ) -> tuple[HelpDocument, DocStats | None]:
+        """Calls translate_doc, and measures it when hyperhelp_profile is enabled."""
+        if not self.config.hyperhelp_profile:
+            return self.translate_doc(docname, doctree), None
+
+        profiler = cProfile.Profile() if self.config.hyperhelp_profile_top else None
+        start = time.perf_counter()
+        if profiler:
+            doc = profiler.runcall(self.translate_doc, docname, doctree)
+            profiler.create_stats()
+        else:
+            doc = self.translate_doc(docname, doctree)
+        stats = DocStats(
+            docname,
+            seconds=time.perf_counter() - start,
+            topics=len(doc.help_file.topics),
+            links=len(doc.links),
+            externals=len(doc.externals),
+            bytes=(
+                self.writer.streamed.bytes
+                if self.writer.streamed
+                else sum(len(o.encode("utf-8")) for o in self.writer.outputs.values())
+            ),
+            profile=profiler.stats if profiler else None,  # type: ignore
+        )
+        return doc, stats
 
-    def write_doc(self, docname: str, doctree: Node) -> None:
+    def translate_doc(self, docname: str, doctree: nodes.document) -> HelpDocument:
+        """Writes one document, and returns the topics and links it contains.
+
+        This can run in a subprocess, so it must not modify the builder state.
+        """
         assert docname
-        self.current_helpfile = HelpFile()
-        target = self.get_target_uri(docname)
-        self.index.help_files[target] = self.current_helpfile
-
-        super().write_doc(docname, doctree)
-
-    def add_topic(
-        self, topic: str, caption: str = "", aliases: list[str] = []
-    ) -> HelpTopic:
-        caption = caption or topic
-        target = self.get_target_uri(self.current_docname)
-        conflict = self._resolved_topics.get(topic)
-        if conflict:
-            # TODO: We actually have a lot of conflict because we generate topic
-            # for each title. Some of those titles are never referenced, or are
-            # referenced only in ToC.
-            # We should try to use more precise uri for ToC and generate less aliases.
-            # logger.warning(f"conflict for topic {topic} (from files {target} and {conflict}")
-            pass
-
-        more_aliases = []
-        for alias in [topic] + aliases:
-            self._resolved_topics[alias] = target
-            more_aliases.append("/".join((target, alias)))
-
-        help_topic = HelpTopic(topic, caption=caption, aliases=aliases + more_aliases)
-        self.current_helpfile.topics.append(help_topic)
-        return help_topic
+        self.current_docname = docname
+        self.secnumbers = self.env.toc_secnumbers.get(docname, {})
+        if (
+            self.config.hyperhelp_stream_output
+            and not self.config.hyperhelp_max_file_size
+        ):
+            return self.stream_doc(docname, doctree)
+        destination = StringOutput(encoding="utf-8")
+        self.writer.write(doctree, destination)
+        doc = self.writer.help_document
+        outputs = self.writer.outputs
+        doc.digest = digest("".join(outputs.values()))
+        outdir = Path(self.outdir)
+        if self.manifest.get(doc.target) == doc.digest and all(
+            (outdir / os_path(target)).exists() for target in outputs
+        ):
+            return doc
+        for target, output in outputs.items():
+            outfilename = outdir / os_path(target)
+            ensuredir(str(outfilename.parent))
+            try:
+                outfilename.write_text(output, encoding="utf-8")
+            except OSError as err:
+                logger.warning(__("error writing file %s: %s"), outfilename, err)
+        return doc
+
+    def stream_doc(self, docname: str, doctree: nodes.document) -> HelpDocument:
+        """Same as translate_doc, but writes the document while translating it.
+
+        The document is written in a temporary file,
+        that replaces the previous help file if it changed.
+        """
+        outfilename = Path(self.outdir) / (os_path(docname) + self.out_suffix)
+        ensuredir(str(outfilename.parent))
+        tmp_outfilename = outfilename.with_name(outfilename.name + ".tmp")
+        destination = StringOutput(encoding="utf-8")
+        try:
+            with open(tmp_outfilename, "w", encoding="utf-8", buffering=2**16) as f:
+                self.writer.stream = f
+                self.writer.write(doctree, destination)
+        finally:
+            self.writer.stream = None
+        doc = self.writer.help_document
+        doc.digest = self.writer.streamed.digest  # type: ignore
+        if self.manifest.get(doc.target) == doc.digest and outfilename.exists():
+            tmp_outfilename.unlink()
+        else:
+            os.replace(tmp_outfilename, outfilename)
+        return doc
+
+    def merge_document(self, doc: HelpDocument, stats: DocStats | None = None) -> None:
+        state = self.state
+        state.index.help_files[doc.target] = doc.help_file
+        state.index.externals.update(doc.externals)
+        self.manifest[doc.target] = doc.digest
+        state.offsets.update(doc.offsets)
+        previous_parts = self.parts.pop(doc.target, [])
+        if doc.parts:
+            self.parts[doc.target] = doc.parts
+        self.remove_stale_parts(doc, previous_parts)
+        # The written document is more accurate than what was collected
+        # while reading, notably if some nodes were removed.
+        help_documents(self.env)[doc.docname] = doc
+        if state.stats is not None and stats is not None:
+            state.stats.add_doc(stats)
+
+    def remove_stale_parts(self, doc: HelpDocument, previous: list[HelpPart]) -> None:
+        """Removes the part files of the previous build that doc doesn't write."""
+        targets = {doc.target} | {part.target for part in doc.parts}
+        for part in previous:
+            if part.target in targets:
+                continue
+            outfilename = Path(self.outdir) / os_path(part.target)
+            try:
+                outfilename.unlink(missing_ok=True)
+            except OSError as err:
+                logger.warning(__("error removing file %s: %s"), outfilename, err)
+
+    def _write_parallel(self, docnames: Sequence[str], nproc: int) -> None:
+        """Same as Builder._write_parallel, but sends back the written documents."""
+
+        def write_process(docs: list[tuple[str, nodes.document]]) -> list[tuple]:
+            self.app.phase = BuildPhase.WRITING
+            return [self.profile_doc(docname, doctree) for docname, doctree in docs]
+
+        def merge(docs: list[tuple[str, nodes.document]], results: list[tuple]) -> None:
+            for doc, stats in results:
+                self.merge_document(doc, stats)
+
+        # warm up caches using the first document
+        firstname, docnames = docnames[0], docnames[1:]
+        self.app.phase = BuildPhase.RESOLVING
+        doctree = self.env.get_and_resolve_doctree(firstname, self)
+        self.app.phase = BuildPhase.WRITING
+        self.write_doc_serialized(firstname, doctree)
+        self.write_doc(firstname, doctree)
+
+        tasks = ParallelTasks(nproc)
+        chunks = make_chunks(docnames, nproc)
+
+        self.app.phase = BuildPhase.RESOLVING
+        for chunk in status_iterator(
+            chunks,
+            __("writing output... "),
+            "darkgreen",
+            len(chunks),
+            self.app.verbosity,
+        ):
+            arg = []
+            for docname in chunk:
+                doctree = self.env.get_and_resolve_doctree(docname, self)
+                self.write_doc_serialized(docname, doctree)
+                arg.append((docname, doctree))
+            tasks.add_task(write_process, arg, merge)
+
+        # make sure all processes have finished
+        logger.info(bold(__("waiting for workers...")))
+        tasks.join()
+
+
+def peak_rss_mb() -> float:
+    """Peak memory used by this process, 0 if unknown."""
+    try:
+        import resource
+    except ImportError:
+        # Not available on Windows
+        return 0.0
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux returns kilobytes, MacOS returns bytes.
+    return maxrss / 2**20 if sys.platform == "darwin" else maxrss / 2**10
+
+
+def git_dates(srcdir: Path) -> dict[str, date]:
+    """Date of the last commit modifying each file of the given directory.
+
+    Uses only one git command, files are keyed by their absolute path.
+    """
+    cmd = ["git", "log", "--format=%x00%cs", "--name-only", "--relative", "--", "."]
+    try:
+        log = subprocess.run(
+            cmd, cwd=srcdir, check=True, capture_output=True, text=True
+        ).stdout
+    except (OSError, subprocess.CalledProcessError) as e:
+        logger.warning(f"Can't read git dates of {srcdir}, using file dates: {e}")
+        return {}
+
+    dates: dict[str, date] = {}
+    for commit in log.split("\0")[1:]:
+        commit_date, *files = commit.split("\n")
+        day = date.fromisoformat(commit_date)
+        for file in files:
+            # git log goes from the most recent to the oldest commit.
+            if file:
+                dates.setdefault(str(srcdir / file), day)
+    return dates
 
 
 def setup(app: Sphinx) -> Dict[str, Any]:
     app.add_builder(HyperHelpBuilder)
+    app.add_env_collector(HyperHelpCollector)
+    app.add_transform(IsolatedTargets)
 
     app.add_config_value("hyperhelp_prune_topics", True, "env", str)
+    # Write hyperhelp.json without indentation
+    app.add_config_value("hyperhelp_compact_index", False, "", bool)
+    # Date written in the help files header: "mtime" of the source, or last "git" commit
+    app.add_config_value("hyperhelp_date", "mtime", "env", ENUM("mtime", "git"))
+    # Write build_stats.json with the time spent on each document and phase
+    app.add_config_value("hyperhelp_profile", False, "", bool)
+    # Also dump the cProfile stats of the N slowest documents in outdir/profiles
+    app.add_config_value("hyperhelp_profile_top", 0, "", int)
+    # Write the help files while translating them, instead of building them in memory.
+    # Ignored when hyperhelp_max_file_size is set.
+    app.add_config_value("hyperhelp_stream_output", False, "", bool)
+    # Split the documents bigger than this many bytes by top-level sections, 0 to disable
+    app.add_config_value("hyperhelp_max_file_size", 0, "env", int)
 
     return {
         "version": "builtin",
+        "env_version": 5,
         "parallel_read_safe": True,
-        "parallel_write_safe": False,
+        "parallel_write_safe": True,
     }
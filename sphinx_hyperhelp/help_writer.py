@@ -1,19 +1,27 @@
 from __future__ import annotations
 
 import collections
+import functools
+import hashlib
 import logging
 import re
 import textwrap
-from datetime import datetime
 from pathlib import Path
-from typing import TYPE_CHECKING, Optional
+from typing import IO, TYPE_CHECKING, Optional, cast
 
 import sphinx.addnodes
 from docutils import nodes
 from docutils.nodes import Element, Node, Text
 from sphinx.writers.text import TextTranslator, TextWriter
 
-from .hyperhelp import HelpExternal, HelpFile, HelpTopic
+from .hyperhelp import (
+    HelpDocument,
+    HelpExternal,
+    HelpFile,
+    HelpPart,
+    HelpTopic,
+    external_topic,
+)
 
 if TYPE_CHECKING:
     from .help_builder import HyperHelpBuilder
@@ -49,6 +57,92 @@ class TopicRef(str):
         return self
 
 
+# Split the generated text into words for wrapping.
+# We need to keep links in one piece.
+WORDSEP_RE = long_re(
+    whitespace=r"\s+",
+    # hyperhelp_link=r"(?:\|:[^|]+\|)",
+    # TODO: do we need this in HyperHelp ?
+    interpreted_text=r"(?<=\s)(?::[a-z-]+:)?`\S+",
+    hyphenated=r"[^\s\w]*\w+[a-zA-Z]-(?=\w+[a-zA-Z])",
+    em_dash=r"(?<=[\w\!\"\'\&\.\,\?])-{2,}(?=\w)",
+)
+WHITESPACE_RE = re.compile(r"(\s+)")
+WHITESPACE_TRANS = {ord(c): " " for c in textwrap._whitespace}  # type: ignore
+
+
+class LineWrapper:
+    """Wraps text fragments to the given width, without splitting TopicRef.
+
+    Produces the same lines than `textwrap.TextWrapper(width, break_long_words=False)`
+    using WORDSEP_RE, but the visible width of each chunk is computed only once,
+    and the text is split without going through TextWrapper private methods.
+    """
+
+    def __init__(self, width: int):
+        if width <= 0:
+            raise ValueError(f"invalid width {width!r} (must be > 0)")
+        self.width = width
+
+    def split(self, fragments: list[str]) -> list[str]:
+        chunks: list[str] = []
+        for fragment in fragments:
+            if isinstance(fragment, TopicRef):
+                # Don't split references
+                chunks.append(fragment)
+                continue
+            if "\t" in fragment:
+                fragment = fragment.expandtabs()
+            fragment = fragment.translate(WHITESPACE_TRANS)
+            # Words and whitespaces alternate, starting with a (maybe empty) word.
+            parts = WHITESPACE_RE.split(fragment)
+            if "-" not in fragment and "`" not in fragment:
+                chunks.extend(filter(None, parts))
+                continue
+            for i, part in enumerate(parts):
+                if i % 2 == 1 or not ("-" in part or "`" in part):
+                    if part:
+                        chunks.append(part)
+                    continue
+                # Only words with "-" or "`" need the slower WORDSEP_RE.
+                # WORDSEP_RE can look at the previous whitespace, so we keep one.
+                if i > 0:
+                    chunks.extend(c for c in WORDSEP_RE.split(" " + part)[2:] if c)
+                else:
+                    chunks.extend(c for c in WORDSEP_RE.split(part) if c)
+        return chunks
+
+    def wrap(self, fragments: list[str]) -> list[str]:
+        chunks = self.split(fragments)
+        widths = [len(c) for c in chunks]
+        width, n = self.width, len(chunks)
+        lines: list[str] = []
+        i = 0
+        while i < n:
+            # Drop whitespace at the beginning of lines, except the first one.
+            if lines and chunks[i].strip() == "":
+                i += 1
+            start, line_width = i, 0
+            while i < n and line_width + widths[i] <= width:
+                line_width += widths[i]
+                i += 1
+            if i == start and i < n:
+                # Long words are put on their own line.
+                i += 1
+            end = i
+            # Drop whitespace at the end of lines.
+            if end > start and chunks[end - 1].strip() == "":
+                end -= 1
+            if end > start:
+                lines.append("".join(chunks[start:end]))
+        return lines
+
+
+@functools.lru_cache()
+def line_wrapper(width: int) -> LineWrapper:
+    return LineWrapper(width)
+
+
 ANCHOR_NODES = (
     nodes.section,
     nodes.term,
@@ -57,6 +151,207 @@ ANCHOR_NODES = (
 )
 
 
+def mark_isolated_targets(document: nodes.document) -> None:
+    """Detect isolated <target> nodes, and mark them.
+
+    The actual anchor will be generated later during visit_target
+    Most <target> nodes are preceding a title
+    and we don't need to generate an extra anchor.
+    This is done once per document, by the IsolatedTargets transform.
+    """
+    parents = {id(t.parent): t.parent for t in document.traverse(nodes.target)}
+    for parent in parents.values():
+        children = parent.children
+        for i, target in enumerate(children):
+            if not isinstance(target, nodes.target):
+                continue
+            if not target.get("ids") and not target.get("refid"):
+                continue
+            target.attributes["isolated"] = is_isolated(children, i)
+
+
+def is_isolated(children: list[Node], i: int) -> bool:
+    """Whether the i-th child is a target that isn't followed by its own anchor."""
+    if i + 1 < len(children):
+        return not isinstance(children[i + 1], ANCHOR_NODES)
+    return not labels_next_section(children[i])
+
+
+def labels_next_section(target: Node) -> bool:
+    """Whether the target is the label of the section following its parent.
+
+    A label written just before a title ends up at the end of the previous section,
+    docutils moves its id to the next section, that has its own anchor.
+    """
+    refid = target.get("refid")  # type: ignore
+    node = target
+    while refid and node.parent is not None:
+        parent = node.parent
+        i = parent.index(node)
+        if i + 1 < len(parent.children):
+            following = parent.children[i + 1]
+            return isinstance(following, nodes.section) and refid in following["ids"]
+        node = parent
+    return False
+
+
+def target_topic(node: Element) -> Optional[str]:
+    """Topic of an isolated <target> node, None if the target isn't isolated."""
+    if not node.get("ids") and not node.get("refid"):
+        return None
+    isolated = node.get("isolated")
+    if isolated is None:
+        # Doctrees cached before IsolatedTargets existed aren't marked.
+        parent = node.parent
+        isolated = parent is None or is_isolated(parent.children, parent.index(node))
+    if not isolated:
+        return None
+    return node.get("refid") or node["ids"][0]
+
+
+def signature_topic(node: Element) -> Optional[str]:
+    """Topic of nodes generating an anchor: signatures, terms, ..."""
+    return node["ids"][0] if node["ids"] else None
+
+
+def add_title_topic(doc: HelpDocument, node: Element) -> Optional[str]:
+    """Registers the topic of a title, using the ids of the parent section."""
+    parent = node.parent
+    if not parent["ids"]:
+        return None
+    topic, aliases = parent["ids"][0], parent["ids"][1:]
+    doc.add_topic(topic, caption=node.astext(), aliases=aliases)
+    return topic
+
+
+def is_internal_reference(node: Element) -> bool:
+    if "internal" in node:
+        return node["internal"]
+    elif "refuri" in node:
+        # Not all nodes have the "internal" field set
+        external = (
+            node["refuri"].startswith("https://")
+            or node["refuri"].startswith("http://")
+            or node["refuri"].startswith("mailto:")
+        )
+        return not external
+    elif "refid" in node:
+        return True
+    else:
+        assert False, f"Invalid reference node: {node} ({node.attributes})"
+
+
+def reference_topic(node: Element) -> Optional[str]:
+    """Topic targeted by an internal reference."""
+    # Replace 'refuri' in reference with HTTP address, if possible
+    # None for no possible address
+    uri = node.get("refuri")
+    if uri:
+        # this is a global ID
+        if uri.startswith("#"):
+            topic = uri[1:]
+        elif "#" in uri:
+            topic = uri.replace("#", "/")
+        else:
+            topic = uri
+    else:
+        topic = node.get("refid")
+    if not topic:
+        return None
+    assert "/../" not in topic
+    assert "#" not in topic
+    return topic
+
+
+# Marks the start of a top-level section in the translated text,
+# followed by the index of the section. See `HyperHelpTranslator.split_document`.
+SECTION_BREAK = "\x00"
+SECTION_BREAK_RE = re.compile(r"^\x00(\d+)\n", re.MULTILINE)
+
+
+class AnchorLocator:
+    """Finds the (line, byte offset) of each anchor in the final text.
+
+    The anchors are given in the order they were emitted, as (topic, markup),
+    so the text is scanned only once, even if it's fed in several chunks.
+    Anchors that have been split by the line wrapping are skipped.
+    """
+
+    def __init__(self, anchors: list[tuple[str, str]]):
+        # The translator keeps appending to this list.
+        self.anchors = anchors
+        # First anchor that hasn't been found yet.
+        self.next = 0
+        self.line = 0
+        self.offset = 0
+        self.offsets: dict[str, tuple[int, int]] = {}
+
+    def feed(self, text: str) -> None:
+        pos = 0
+        for i in range(self.next, len(self.anchors)):
+            topic, markup = self.anchors[i]
+            start = text.find(markup, pos)
+            if start < 0:
+                continue
+            self.advance(text[pos:start])
+            pos = start
+            self.offsets.setdefault(topic, (self.line, self.offset))
+            self.next = i + 1
+        self.advance(text[pos:])
+
+    def advance(self, chunk: str) -> None:
+        self.line += chunk.count("\n")
+        self.offset += len(chunk.encode("utf-8"))
+
+
+def locate_anchors(
+    text: str, anchors: list[tuple[str, str]]
+) -> dict[str, tuple[int, int]]:
+    locator = AnchorLocator(anchors)
+    locator.feed(text)
+    return locator.offsets
+
+
+class StreamedOutput:
+    """Writes a help file while it's being translated.
+
+    It also computes the hash of the file and the position of the anchors,
+    that are otherwise computed from the full text.
+    """
+
+    def __init__(self, file: IO[str], anchors: list[tuple[str, str]]):
+        self.file = file
+        self.sha1 = hashlib.sha1()
+        self.locator = AnchorLocator(anchors)
+
+    def write(self, text: str) -> None:
+        self.file.write(text)
+        self.sha1.update(text.encode("utf-8"))
+        self.locator.feed(text)
+
+    @property
+    def digest(self) -> str:
+        return self.sha1.hexdigest()
+
+    @property
+    def bytes(self) -> int:
+        return self.locator.offset
+
+
+@functools.lru_cache(maxsize=2**14)
+def make_external(uri: Optional[str]) -> Optional[HelpExternal]:
+    """Converts the uri of an external reference to an HyperHelp external.
+
+    Docs often link to the same few uris, they share the same external,
+    and its topic is only computed once.
+    """
+    if not uri:
+        return None
+    if uri.startswith("mailto:"):
+        return None
+    return HelpExternal(external_topic(uri), uri, caption=uri)
+
+
 class HyperHelpTranslator(TextTranslator):
     def __init__(self, document, builder: HyperHelpBuilder):
         self.builder: HyperHelpBuilder = builder
@@ -71,29 +366,146 @@ class HyperHelpTranslator(TextTranslator):
         self.head: list[str] = []
         self.foot: list[str] = []
         self.body = ""
+        # Anchors emitted so far, as (topic, markup), see `locate_anchors`.
+        self.anchors: list[tuple[str, str]] = []
+        # Documents bigger than this are split by top-level sections, 0 to disable.
+        self.max_file_size: int = builder.config.hyperhelp_max_file_size
+        # Top-level sections, as (title, first topic, first anchor).
+        self.sections: list[tuple[str, int, int]] = []
+        # Text of each help file written for this document.
+        self.outputs: dict[str, str] = {}
+        # When set, the top-level blocks are written as soon as they are complete,
+        # instead of building the full text in `body`. See `flush_body`.
+        self.stream: StreamedOutput | None = None
+        self.streamed_body = False
+
+        docname = builder.current_docname
+        self.doc = HelpDocument(docname, builder.get_target_uri(docname))
 
-        self.helpfile: HelpFile = None  # type: ignore
+    @property
+    def helpfile(self) -> HelpFile:
+        return self.doc.help_file
 
     def visit_document(self, node: Element) -> None:
         super().visit_document(node)
         logger.debug(f"Visiting: {node['source']}")
-        assert self.helpfile is None
-        self.helpfile = self.builder.current_helpfile
-        self.builder._doctree = node
+        self.builder._doctree = cast(nodes.document, node)
         self.builder._translator = self
         if self.builder.current_docname in DEBUG_DOCS:
             breakpoint()
 
     def depart_document(self, node: Element) -> None:
         super().depart_document(node)
+        if self.stream is not None:
+            return self.depart_streamed_document()
         # This just has been set
-        body = self.body
-        assert self.helpfile is not None
-        self.helpfile = None  # type: ignore
+        chunks = SECTION_BREAK_RE.split(self.body)
+        body = "".join(chunks[::2])
         head, foot = ["".join(lines).strip() for lines in (self.head, self.foot)]
         if not foot.endswith("\n"):
             foot += "\n"
         self.body = "\n\n".join(part for part in (head, body, foot) if part)
+        if len(chunks) > 1 and len(self.body.encode("utf-8")) > self.max_file_size:
+            self.split_document(head, chunks, foot)
+        if not self.doc.parts:
+            self.outputs = {self.doc.target: self.body}
+            self.doc.offsets = {
+                self.doc.target: locate_anchors(self.body, self.anchors)
+            }
+
+    def flush_body(self) -> None:
+        """Writes the complete top-level blocks to the stream.
+
+        Only the text that hasn't been wrapped yet is kept in memory,
+        the output is the same as when building the full body.
+        """
+        assert self.stream is not None
+        content = self.states[-1]
+        complete = [i for i, (indent, _) in enumerate(content) if indent != -1]
+        if not self.title_found or not complete:
+            # The head is written first, so wait until we know the document title.
+            return
+        blocks = content[: complete[-1] + 1]
+        del content[: complete[-1] + 1]
+        result = self.format_state(blocks, self.stateindent[-1])
+        lines = [line and (" " * indent + line) for indent, ls in result for line in ls]
+        if not lines:
+            return
+        if self.streamed_body:
+            self.stream.write("\n")
+        else:
+            head = "".join(self.head).strip()
+            if head:
+                self.stream.write(head + "\n\n")
+            self.streamed_body = True
+        self.stream.write("\n".join(lines))
+
+    def depart_streamed_document(self) -> None:
+        assert self.stream is not None
+        # This just has been set, with the blocks that haven't been written yet.
+        body = self.body
+        head, foot = ["".join(lines).strip() for lines in (self.head, self.foot)]
+        if not foot.endswith("\n"):
+            foot += "\n"
+        if self.streamed_body:
+            tail = "\n" + body if self.states[0] else ""
+            self.stream.write(tail + "\n\n" + foot)
+        else:
+            self.stream.write("\n\n".join(part for part in (head, body, foot) if part))
+        self.body = ""
+        self.doc.offsets = {self.doc.target: self.stream.locator.offsets}
+
+    def split_document(self, head: str, chunks: list[str], foot: str) -> None:
+        """Writes the top-level sections in several help files.
+
+        Consecutive sections are grouped in files of at most `max_file_size` bytes,
+        unless a single section is bigger than that.
+        The first file keeps the target of the document, so links to it still work.
+        """
+        # (section index, text), -1 is the text before the first section.
+        sections = [(-1, chunks[0])]
+        sections += [(int(i), text) for i, text in zip(chunks[1::2], chunks[2::2])]
+        groups: list[list[tuple[int, str]]] = []
+        size = len(head.encode("utf-8"))
+        for section in sections:
+            section_size = len(section[1].encode("utf-8"))
+            if groups and size + section_size <= self.max_file_size:
+                groups[-1].append(section)
+                size += section_size
+            else:
+                groups.append([section])
+                size = section_size
+        if len(groups) == 1:
+            return
+
+        date = self.builder.get_doc_date(self.doc.docname)
+        parts, anchors = [], []
+        for n, group in enumerate(groups):
+            if n == 0:
+                parts.append(HelpPart(self.doc.target, self.helpfile.description, 0))
+                anchors.append(0)
+                continue
+            title, topic, anchor = self.sections[group[0][0]]
+            description = title.replace('"', "") or self.helpfile.description
+            target = self.builder.get_part_uri(self.doc.docname, n + 1)
+            parts.append(HelpPart(target, description, topic))
+            anchors.append(anchor)
+        anchors.append(len(self.anchors))
+
+        for n, (part, group) in enumerate(zip(parts, groups)):
+            if n == 0:
+                header = head
+            else:
+                header = f'%hyperhelp title="{part.description}" date="{date:%Y-%m-%d}"'
+            text = "".join(text for _, text in group).strip("\n")
+            last = n == len(groups) - 1
+            output = "\n\n".join(p for p in (header, text, foot if last else "") if p)
+            if not output.endswith("\n"):
+                output += "\n"
+            self.outputs[part.target] = output
+            part_anchors = self.anchors[anchors[n] : anchors[n + 1]]
+            self.doc.offsets[part.target] = locate_anchors(output, part_anchors)
+        self.doc.parts = parts
 
     @property
     def current_indent(self) -> int:
@@ -105,12 +517,33 @@ class HyperHelpTranslator(TextTranslator):
         """Finalize a block of text by wrapping content if needed"""
         # Copied from TextTranslator. We want to have better control on the wrapping.
         content = self.states.pop()
-        maxindent = self.current_indent
         indent = self.stateindent.pop()
+        result = self.format_state(content, indent, wrap, end)
+        if first is not None and result:
+            # insert prefix into first line (ex. *, [1], See also, etc.)
+            newindent = result[0][0] - indent
+            if result[0][1] == [""]:
+                result.insert(0, (newindent, [first]))
+            else:
+                text = first + result[0][1].pop(0)
+                result.insert(0, (newindent, [text]))
+
+        self.states[-1].extend(result)
+        if self.stream is not None and len(self.states) == 2:
+            self.flush_body()
+
+    def format_state(
+        self,
+        content: list[tuple[int, list[str] | str]],
+        indent: int,
+        wrap: bool = True,
+        end: list[str] = [""],
+    ) -> list[tuple[int, list[str]]]:
+        """Wraps the pending text of a state, and indents its blocks."""
         result: list[tuple[int, list[str]]] = []
         toformat: list[str] = []
 
-        def do_format(maxindent: int) -> None:
+        def do_format() -> None:
             if not toformat:
                 return
             if wrap:
@@ -127,77 +560,40 @@ class HyperHelpTranslator(TextTranslator):
                 assert isinstance(item, str)
                 toformat.append(item)
             else:
-                do_format(maxindent)
+                do_format()
                 assert isinstance(item, list)
                 result.append((indent + itemindent, item))
                 toformat = []
-        do_format(maxindent)
-        if first is not None and result:
-            # insert prefix into first line (ex. *, [1], See also, etc.)
-            newindent = result[0][0] - indent
-            if result[0][1] == [""]:
-                result.insert(0, (newindent, [first]))
-            else:
-                text = first + result[0][1].pop(0)
-                result.insert(0, (newindent, [text]))
+        do_format()
+        return result
 
-        self.states[-1].extend(result)
+    wordsep_re = WORDSEP_RE
 
-    # Split the generated text into words for wrapping.
-    # We need to keep links in one piece.
-    wordsep_re = long_re(
-        whitespace=r"\s+",
-        # hyperhelp_link=r"(?:\|:[^|]+\|)",
-        # TODO: do we need this in HyperHelp ?
-        interpreted_text=r"(?<=\s)(?::[a-z-]+:)?`\S+",
-        hyphenated=r"[^\s\w]*\w+[a-zA-Z]-(?=\w+[a-zA-Z])",
-        em_dash=r"(?<=[\w\!\"\'\&\.\,\?])-{2,}(?=\w)",
-    )
-
-    def get_wrapper(self, width: int = None) -> textwrap.TextWrapper:
-        if width is None:
-            width = self.maxwidth
-        wrapper = textwrap.TextWrapper(width=width, break_long_words=False)
-        wrapper.wordsep_re = self.wordsep_re
-        return wrapper
-
-    def split(self, fragments: list[str] | str, wrapper=None) -> list[str]:
+    def get_wrapper(self, width: int = None) -> LineWrapper:
+        return line_wrapper(width or self.maxwidth)
+
+    def split(self, fragments: list[str] | str) -> list[str]:
         if isinstance(fragments, str):
             fragments = [fragments]
-        if wrapper is None:
-            wrapper = self.get_wrapper()
-        chunks: list[str] = []
-        for fragment in fragments:
-            if isinstance(fragment, TopicRef):
-                # Don't split references
-                chunks.append(fragment)
-            else:
-                fragment = wrapper._munge_whitespace(fragment)
-                chunks.extend(wrapper._split(fragment))
-        return chunks
+        return self.get_wrapper().split(fragments)
 
     def wrap(self, fragments: list[str], width: int) -> list[str]:
-        # We don't directly call wrapper.wrap, but do our own splitting instead
-        # This allows to not split in the middle of a link.
-        # TODO: would it be better to inherit from TextWrapper instead ?
         # TODO: sphinx has a custom _wrap_chunks that handle utf-8 combining chars
         # I've disabled it because using `len` to compute the visible len of strings
         # allows to override it in `TopicRef` class.
-        wrapper = self.get_wrapper(width)
-        chunks = self.split(fragments)
-        return wrapper._wrap_chunks(chunks)
+        return self.get_wrapper(width).wrap(fragments)
 
     def visit_desc_signature(self, node: Element) -> None:
         super().visit_desc_signature(node)
-        if not node["ids"]:
+        topic = signature_topic(node)
+        if not topic:
             return
 
-        topic = node["ids"][0]
         if topic in DEBUG_TOPICS:
             breakpoint()
-        self.builder.add_topic(topic)
+        self.doc.add_topic(topic)
         # TODO: should we use a more explicit alias here ?
-        self.add_text(f"*{topic}:")
+        self.add_text(self.add_anchor(topic, "*{}:"))
 
     def depart_desc_signature(self, node: Element) -> None:
         topic = node["ids"]
@@ -229,9 +625,19 @@ class HyperHelpTranslator(TextTranslator):
     depart_doctest_block = depart_literal_block
 
     def visit_section(self, node: Element) -> None:
-        if self.title_found:
+        if not self.title_found:
             # Don't treat the first section as a section
-            super().visit_section(node)
+            return
+        if self.max_file_size and self.sectionlevel == 0:
+            self.add_section_break(node)
+        super().visit_section(node)
+
+    def add_section_break(self, node: Element) -> None:
+        """Marks the start of a top-level section, where the document can be split."""
+        first = node.children[0] if node.children else None
+        title = first.astext() if isinstance(first, nodes.title) else ""
+        self.states[-1].append((0, [f"{SECTION_BREAK}{len(self.sections)}"]))
+        self.sections.append((title, len(self.helpfile.topics), len(self.anchors)))
 
     def add_title_as_topic(self, node: Element) -> Optional[str]:
         assert self.helpfile
@@ -243,11 +649,7 @@ class HyperHelpTranslator(TextTranslator):
         if any(alias in DEBUG_TOPICS for alias in parent["ids"]):
             breakpoint()
 
-        topic, aliases = parent["ids"][0], parent["ids"][1:]
-        help_topic = self.builder.add_topic(
-            topic, caption=node.astext(), aliases=aliases
-        )
-        return topic
+        return add_title_topic(self.doc, node)
 
     def visit_title(self, node: Element) -> None:
         # Note: not calling super
@@ -260,7 +662,7 @@ class HyperHelpTranslator(TextTranslator):
         lvl = self.sectionlevel
         topic = self.add_title_as_topic(node)
         if topic:
-            self.add_text(f"{lvl * '#'} {topic}:")
+            self.add_text(self.add_anchor(topic, lvl * "#" + " {}:"))
         else:
             self.add_text(f"{lvl * '#'} ")
 
@@ -271,9 +673,8 @@ class HyperHelpTranslator(TextTranslator):
         """
         assert not self.title_found
         assert not self.helpfile.description
-        # TODO: use git/file date ?
         title = node.children[0].astext().replace('"', "")
-        date = datetime.today()
+        date = self.builder.get_doc_date(self.doc.docname)
         self.helpfile.add_description(title)
         self.head.append(f'%hyperhelp title="{title}" date="{date:%Y-%m-%d}"\n')
         # TODO: this should not be collapsed with the upcoming title
@@ -285,101 +686,57 @@ class HyperHelpTranslator(TextTranslator):
         raise nodes.SkipNode
 
     def make_anchor(self, topic: str) -> str:
-        return f"*|{topic}:⚓|*\n"
-
-    def depart_title(self, node: Element):
-        pass
-
-    def dispatch_visit(self, node: Node) -> None:
-        if isinstance(node, Element):
-            self.detect_isolated_target(node)
+        return self.add_anchor(topic, "*|{}:⚓|*") + "\n"
 
-        super().dispatch_visit(node)
+    def add_anchor(self, topic: str, markup: str) -> str:
+        """Formats the anchor markup, and remembers it to locate it in the output."""
+        name = self.anchor_name(topic)
+        anchor = markup.format(name)
+        self.anchors.append((name, anchor))
+        return anchor
 
-    def detect_isolated_target(self, node: Element) -> None:
-        """Detect isolated <target> nodes, and mark them.
+    def anchor_name(self, topic: str) -> str:
+        """Anchors of topics owned by another file are qualified by the file name."""
+        topic_index = self.builder.topic_index
+        return topic_index.anchor(self.doc.target, topic) if topic_index else topic
 
-        The actual anchor will be generated later during visit_target
-        Most <target> nodes are preceding a title
-        and we don't need to generate an extra anchor.
-        """
-        n = len(node.children)
-        for i, target in enumerate(node.children):
-            if not isinstance(target, nodes.target):
-                continue
-            if not target.get("ids") and not target.get("refid"):
-                continue
-            isolated = True
-            if i + 1 < n:
-                sibling = node.children[i + 1]
-                if isinstance(sibling, ANCHOR_NODES):
-                    isolated = False
-            target.attributes["isolated"] = isolated
+    def depart_title(self, node: Element):
+        pass
 
     def visit_target(self, node: Element) -> None:
-        isolated = node.get("isolated", False)
-        if not isolated:
+        topic = target_topic(node)
+        if topic is None:
             raise nodes.SkipNode
-        topic = node.get("refid") or node["ids"][0]
         if topic:
-            self.builder.add_topic(topic)
+            self.doc.add_topic(topic)
             self.add_text(self.make_anchor(topic))
 
     def depart_target(self, node: Element) -> None:
         pass
 
     def uri2external(self, node: Element) -> Optional[str]:
-        uri = node.get("refuri")
-        if not uri:
-            return None
-        if uri.startswith("mailto:"):
+        external = make_external(node.get("refuri"))
+        if external is None:
             return None
-        topic = uri.split("://")[-1].strip("/")
         # TODO? ping the uri to fetch page title and description ?
-        # TODO: prevent duplicate
-        self.builder.index.externals[uri] = HelpExternal(topic, uri, caption=uri)
-        return topic
+        self.doc.add_external(external)
+        return external.topic
 
     def uri2topic(self, node: Element) -> Optional[str]:
-        # Replace 'refuri' in reference with HTTP address, if possible
-        # None for no possible address
-        uri = node.get("refuri")
-        if uri:
-            # this is a global ID
-            if uri.startswith("#"):
-                topic = uri[1:]
-            elif "#" in uri:
-                topic = uri.replace("#", "/")
-            else:
-                topic = uri
-        else:
-            topic = node.get("refid")
+        topic = reference_topic(node)
         if not topic:
             return None
         if topic in DEBUG_TOPICS:
             breakpoint()
 
-        self.builder.links[topic] = self.builder.current_docname
-        assert "/../" not in topic
-        assert "#" not in topic
+        topic_index = self.builder.topic_index
+        if topic_index:
+            topic = topic_index.link(self.doc.target, topic)
+        self.doc.add_link(topic)
         return topic
 
     def visit_reference(self, node: Element) -> None:
-        if "internal" in node:
-            internal = node["internal"]
-        elif "refuri" in node:
-            # Not all nodes have the "internal" field set
-            external = (
-                node["refuri"].startswith("https://")
-                or node["refuri"].startswith("http://")
-                or node["refuri"].startswith("mailto:")
-            )
-            internal = not external
-        elif "refid" in node:
-            internal = True
-        else:
-            assert False, f"Invalid reference node: {node} ({node.attributes})"
-
+        internal = is_internal_reference(node)
         if internal:
             topic = self.uri2topic(node)
         else:
@@ -407,3 +764,34 @@ class HyperHelpWriter(TextWriter):
     """Final translated form of `document`."""
 
     translator_class = HyperHelpTranslator
+
+    outputs: dict[str, str]
+    """Text of each help file, several when the document is split by sections."""
+
+    help_document: HelpDocument = None  # type: ignore
+    """Topics and links of `document`."""
+
+    stream: IO[str] | None = None
+    """When set, the help file is written there while translating, see `streamed`."""
+
+    streamed: StreamedOutput | None = None
+    """Hash, size and anchors of the streamed help file. `output` is then empty."""
+
+    def __init__(self, builder: HyperHelpBuilder):
+        super().__init__(builder)
+        self.outputs = {}
+
+    def translate(self) -> None:
+        visitor = cast(
+            HyperHelpTranslator,
+            self.builder.create_translator(self.document, self.builder),
+        )
+        assert self.document is not None
+        self.streamed = None
+        if self.stream is not None:
+            self.streamed = StreamedOutput(self.stream, visitor.anchors)
+            visitor.stream = self.streamed
+        self.document.walkabout(visitor)
+        self.output = visitor.body
+        self.outputs = visitor.outputs
+        self.help_document = visitor.doc
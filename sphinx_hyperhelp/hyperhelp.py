@@ -1,31 +1,148 @@
 from __future__ import annotations
 
+import filecmp
+import hashlib
 import json
+import os
+import re
+import sys
+from functools import partial
 from pathlib import Path
-from typing import Any, NamedTuple
+from typing import IO, Any, Container, Iterable, Iterator, NamedTuple, Sequence
+
+
+def digest(content: str) -> str:
+    return hashlib.sha1(content.encode("utf-8")).hexdigest()
+
+
+def help_target(docname: str) -> str:
+    """Name of the help file of a document."""
+    return docname + ".txt"
+
+
+def replace_if_changed(tmp_path: Path, path: Path) -> bool:
+    """Moves tmp_path to path, unless path already has the same content."""
+    if path.exists() and filecmp.cmp(tmp_path, path, shallow=False):
+        tmp_path.unlink()
+        return False
+    os.replace(tmp_path, path)
+    return True
+
+
+def dump_json_items(
+    file: IO[str], items: Iterable[tuple[str, Any]], indent: int = None, level: int = 0
+) -> None:
+    """Writes a json object to the file, one item at a time.
+
+    Values that are iterators of (key, value) are streamed as nested objects,
+    other values are written with json.dumps.
+    The output is the same than `json.dump(dict(items), indent=indent)`.
+    """
+    if indent is None:
+        newline, key_sep, dumps = "", ":", json.dumps
+    else:
+        newline, key_sep = "\n" + " " * (indent * (level + 1)), ": "
+        dumps = partial(json.dumps, indent=indent)
+    separators = None if indent is not None else (",", ":")
+
+    file.write("{")
+    first = True
+    for key, value in items:
+        file.write(newline if first else "," + newline)
+        first = False
+        file.write(json.dumps(key) + key_sep)
+        if isinstance(value, Iterator):
+            dump_json_items(file, value, indent, level + 1)
+            continue
+        text = dumps(value, separators=separators)
+        if indent is not None:
+            # Indent nested lines, json.dumps doesn't know about our nesting level.
+            text = text.replace("\n", newline)
+        file.write(text)
+    if not first and indent is not None:
+        file.write("\n" + " " * (indent * level))
+    file.write("}")
+
+
+def write_if_changed(path: Path, content: str) -> bool:
+    """Writes the file, unless it already has this exact content.
+
+    Leaving unchanged files untouched allows to efficiently sync the output.
+    """
+    try:
+        if path.read_text(encoding="utf-8") == content:
+            return False
+    except (OSError, ValueError):
+        pass
+    path.write_text(content, encoding="utf-8")
+    return True
 
 
 class HelpTopic(NamedTuple):
     topic: str
     caption: str = ""
-    aliases: list[str] = []
+    aliases: tuple[str, ...] = ()
+    # The topic and its aliases are also available as "<target>/<alias>".
+    # Those qualified aliases are computed when serializing, instead of being stored.
+    qualified: bool = False
 
-    def as_json(self) -> dict:
-        d: dict = {"topic": self.topic, "caption": self.caption}
-        if self.aliases:
-            d["aliases"] = self.aliases
+    def names(self, target: str = "") -> Iterator[str]:
+        """All the names of this topic, including the qualified aliases."""
+        yield self.topic
+        yield from self.aliases
+        if self.qualified:
+            yield from self.qualified_aliases(target)
+
+    def qualified_aliases(self, target: str) -> Iterator[str]:
+        yield target + "/" + self.topic
+        for alias in self.aliases:
+            yield target + "/" + alias
+
+    def as_json(
+        self, target: str = "", keep: Container[str] = None, owners: TopicIndex = None
+    ) -> dict | None:
+        """Json representation of the topic.
+
+        If `owners` is given, the names owned by other files are dropped.
+        If `keep` is given, only the aliases it contains are written.
+        The main topic is the name of the anchor, so it's always written,
+        unless no name is kept, then this returns None.
+        """
+        if owners is None:
+            names = list(self.names(target))
+        else:
+            names = owners.resolve_names(target, self)
+        if keep is not None:
+            aliases = [name for name in names[1:] if name in keep]
+            if not aliases and names[0] not in keep:
+                return None
+            names = names[:1] + aliases
+        d: dict = {"topic": names[0], "caption": self.caption}
+        if len(names) > 1:
+            d["aliases"] = names[1:]
         return d
 
     def __contains__(self, topic: Any) -> bool:
+        """Whether topic is the name or an alias, use `names` for the qualified ones."""
         return topic == self.topic or topic in self.aliases
 
     @staticmethod
-    def from_json(topic: dict) -> HelpTopic:
-        return HelpTopic(**topic)
+    def from_json(topic: dict, target: str = "") -> HelpTopic:
+        name = sys.intern(topic["topic"])
+        aliases = tuple(sys.intern(a) for a in topic.get("aliases", ()))
+        qualified = False
+        if target:
+            # Detect the qualified aliases written by `as_json`.
+            n = (len(aliases) - 1) // 2
+            if aliases[n:] == tuple(
+                HelpTopic(name, "", aliases[:n]).qualified_aliases(target)
+            ):
+                aliases, qualified = aliases[:n], True
+        return HelpTopic(name, topic.get("caption", ""), aliases, qualified)
 
 
 class HelpFile:
-    def __init__(self, description: str = "", topics: list[HelpTopic] = []):
+    def __init__(self, description: str = "", topics: list[HelpTopic] = None):
         self.description = description
         self.topics: list[HelpTopic] = topics or []
         # self.sources: dict[str, HelpFile] = {}
@@ -34,10 +151,39 @@ class HelpFile:
     def __repr__(self) -> str:
         return f"HelpFile({self.description!r})"
 
-    def as_json(self) -> list:
+    def as_json(
+        self, target: str = "", keep: Container[str] = None, owners: TopicIndex = None
+    ) -> list:
         if not self.description and not self.topics:
             return []
-        return [self.description] + [t.as_json() for t in self.topics]  # type: ignore
+        topics = (t.as_json(target, keep, owners) for t in self.topics)
+        return [self.description] + [t for t in topics if t is not None]
+
+    @staticmethod
+    def from_json(help_file: list, target: str = "") -> HelpFile:
+        if not help_file:
+            return HelpFile()
+        description, *topics = help_file
+        return HelpFile(description, [HelpTopic.from_json(t, target) for t in topics])
+
+    def part(
+        self, description: str, start: int, end: int = None, defined: set[str] = None
+    ) -> HelpFile:
+        """Help file with only the topics from start to end.
+
+        Names in `defined` are dropped, so that names defined by several parts
+        only resolve to the first one, like in a single file.
+        The names of the part are added to `defined`.
+        """
+        topics = self.topics[start:end]
+        if defined is not None:
+            topics = [
+                t._replace(aliases=tuple(a for a in t.aliases if a not in defined))
+                for t in topics
+                if t.topic not in defined
+            ]
+            defined.update(name for t in topics for name in (t.topic, *t.aliases))
+        return HelpFile(description, topics)
 
     def add_description(self, description: str) -> None:
         assert not self.description, f"{self} already got a description"
@@ -51,6 +197,31 @@ class HelpFile:
         ...
 
 
+# Characters that would break a link "|:topic:text|".
+# "~" is reserved to disambiguate the topics that aren't just the uri without "https://".
+UNSAFE_TOPIC_RE = re.compile(r"[\s:|~]")
+SCHEME_RE = re.compile(r"[a-zA-Z][a-zA-Z0-9+.-]*")
+
+
+def external_topic(uri: str) -> str:
+    """Topic of an external link, different for each uri.
+
+    It's the uri without "https://", eg "docs.python.org/3/".
+    Other schemes are kept as a prefix, eg "http~docutils.sourceforge.io",
+    and the uris that can't be written in a link get a hash suffix.
+    """
+    scheme, sep, rest = uri.partition("://")
+    if (
+        sep
+        and rest
+        and SCHEME_RE.fullmatch(scheme)
+        and not UNSAFE_TOPIC_RE.search(rest)
+    ):
+        return rest if scheme == "https" else f"{scheme}~{rest}"
+    readable = UNSAFE_TOPIC_RE.sub("_", rest or uri)
+    return f"{readable}~~{digest(uri)[:8]}"
+
+
 class HelpExternal(NamedTuple):
     topic: str
     uri: str
@@ -59,65 +230,321 @@ class HelpExternal(NamedTuple):
     def as_json(self) -> list:
         return [self.uri, {"topic": self.topic, "caption": self.caption}]
 
+    @staticmethod
+    def from_json(uri: str, external: list) -> HelpExternal:
+        return HelpExternal(uri=uri, **external[1])
+
+
+class HelpPart(NamedTuple):
+    """One of the help files written for a document split by sections."""
+
+    target: str
+    description: str
+    # Position of the first topic of this part, in the help file of the document.
+    start: int
+
+    def as_json(self) -> list:
+        return list(self)
+
+    @staticmethod
+    def from_json(part: list) -> HelpPart:
+        return HelpPart(*part)
+
+
+class HelpDocument:
+    """Everything generated while writing one document.
+
+    Documents are written independently, possibly in other processes,
+    and then merged into the HelpIndex.
+    """
+
+    def __init__(self, docname: str, target: str):
+        self.docname = docname
+        self.target = target
+        self.help_file = HelpFile()
+        # topics referenced by this document
+        self.links: set[str] = set()
+        self.externals: dict[str, HelpExternal] = {}
+        # number of references to each external, by uri
+        self.external_refs: dict[str, int] = {}
+        # hash of the written help file
+        self.digest = ""
+        # Files written for this document, when it's split by sections
+        self.parts: list[HelpPart] = []
+        # (line, byte offset) of each anchor, for each written help file
+        self.offsets: dict[str, dict[str, tuple[int, int]]] = {}
+
+    def __repr__(self) -> str:
+        return f"HelpDocument({self.docname!r})"
+
+    def add_topic(
+        self, topic: str, caption: str = "", aliases: Sequence[str] = ()
+    ) -> HelpTopic:
+        # We have a lot of conflicts because we generate a topic for each title.
+        # They are resolved by TopicIndex: only the first file defining a topic
+        # exposes it, the other ones use their qualified alias.
+        # Topics are interned, so links to the same topic share the same string.
+        topic = sys.intern(topic)
+        help_topic = HelpTopic(
+            topic,
+            caption=caption or topic,
+            aliases=tuple(sys.intern(a) for a in aliases),
+            qualified=True,
+        )
+        self.help_file.topics.append(help_topic)
+        return help_topic
+
+    def add_link(self, topic: str) -> None:
+        self.links.add(sys.intern(topic))
+
+    def add_external(self, external: HelpExternal) -> None:
+        uri = external.uri
+        self.externals.setdefault(uri, external)
+        self.external_refs[uri] = self.external_refs.get(uri, 0) + 1
+
+
+class ExternalIndex:
+    """Externals linked by the documents of a build, deduplicated by uri.
+
+    References are counted, so the externals that aren't linked anymore,
+    eg by a deleted or modified document, can be pruned from the index.
+    """
+
+    def __init__(self) -> None:
+        self.externals: dict[str, HelpExternal] = {}
+        self.refcounts: dict[str, int] = {}
+
+    @staticmethod
+    def from_documents(documents: Iterable[HelpDocument]) -> ExternalIndex:
+        """Indexes the externals of the given documents, in this order."""
+        external_index = ExternalIndex()
+        for doc in documents:
+            external_index.add_document(doc)
+        return external_index
+
+    def add_document(self, doc: HelpDocument) -> None:
+        refcounts = self.refcounts
+        for uri, external in doc.externals.items():
+            self.externals.setdefault(uri, external)
+            refcounts[uri] = refcounts.get(uri, 0) + doc.external_refs[uri]
+
+    def __contains__(self, uri: Any) -> bool:
+        """An external is worth keeping, if it's linked to."""
+        return self.refcounts.get(uri, 0) > 0
+
+    def prune(self, externals: dict[str, HelpExternal]) -> dict[str, HelpExternal]:
+        """Only keeps the given externals that are linked to, in the same order."""
+        return {uri: e for uri, e in externals.items() if uri in self}
+
+
+class TopicIndex:
+    """Index of all the topic names of a build, and of the links to them.
+
+    Each name (topic, alias or qualified alias) is mapped to the file
+    and the position of the topic defining it.
+    Links are reference counted, so the index can validate the links,
+    detect conflicts and tell which topics to keep, after only one pass.
+
+    When several files define the same name, the first file owns it.
+    The other files only expose it with their qualified alias "<target>/<name>".
+    """
+
+    def __init__(self) -> None:
+        self.topics: dict[str, tuple[str, int]] = {}
+        # Files defining a name that is also defined by another file.
+        self.conflicts: dict[str, set[str]] = {}
+        self.refcounts: dict[str, int] = {}
+
+    @staticmethod
+    def from_documents(documents: Iterable[HelpDocument]) -> TopicIndex:
+        """Indexes the topics and links of the given documents, in this order.
+
+        The links are qualified like the writer does, once the owner of each name
+        is known: the documents that weren't written again still have the links
+        collected while reading.
+        """
+        topic_index = TopicIndex()
+        documents = list(documents)
+        for doc in documents:
+            topic_index.add_file(doc.target, doc.help_file)
+        for doc in documents:
+            target = doc.target
+            topic_index.add_links(topic_index.link(target, t) for t in doc.links)
+        return topic_index
+
+    def add_file(self, target: str, help_file: HelpFile) -> None:
+        # files are they own topics, -1 is the position of the file itself.
+        self.topics[target] = (target, -1)
+        for i, help_topic in enumerate(help_file.topics):
+            for name in help_topic.names(target):
+                owner = self.topics.setdefault(name, (target, i))[0]
+                if owner != target:
+                    self.conflicts.setdefault(name, {owner}).add(target)
+
+    def add_links(self, links: Iterable[str]) -> None:
+        refcounts = self.refcounts
+        for link in links:
+            refcounts[link] = refcounts.get(link, 0) + 1
+
+    def __contains__(self, name: Any) -> bool:
+        """A name is worth keeping, if it's linked to."""
+        return self.refcounts.get(name, 0) > 0
+
+    def resolve(self, name: str) -> str | None:
+        """Returns the file defining the given topic."""
+        definition = self.topics.get(name)
+        return definition[0] if definition else None
+
+    def owns(self, target: str, name: str) -> bool:
+        return self.topics.get(name, (target,))[0] == target
+
+    def anchor(self, target: str, topic: str) -> str:
+        """Name of the anchor of the topic, qualified if another file owns it."""
+        return topic if self.owns(target, topic) else target + "/" + topic
+
+    def link(self, target: str, topic: str) -> str:
+        """Topic to link to from the given file.
+
+        Links to an ambiguous topic defined by the same file are qualified,
+        so they resolve to exactly one topic.
+        """
+        if target in self.conflicts.get(topic, ()):
+            return target + "/" + topic
+        return topic
+
+    def resolve_names(self, target: str, help_topic: HelpTopic) -> list[str]:
+        """Names of the topic, without the ones owned by other files."""
+        main = self.anchor(target, help_topic.topic)
+        names = [main]
+        for name in help_topic.names(target):
+            if name != main and ("/" in name or self.owns(target, name)):
+                names.append(name)
+        return names
+
+    def ambiguities(self, target: str, help_file: HelpFile) -> frozenset:
+        """Ambiguous names of a file, and whether the file owns them.
+
+        Anchors and links of the written file depend on this,
+        when it changes the file needs to be written again.
+        """
+        return frozenset(
+            (name, self.owns(target, name))
+            for help_topic in help_file.topics
+            for name in (help_topic.topic, *help_topic.aliases)
+            if name in self.conflicts
+        )
+
+
+class Validation(NamedTuple):
+    """Result of the validation of the links of the index."""
+
+    links: int
+    unresolved: list[str]
+    conflicts: list[str]
+
+    @property
+    def valid(self) -> bool:
+        return not self.unresolved and not self.conflicts
+
 
 class HelpIndex(NamedTuple):
     package: str
     description: str
     doc_root: Path
-    help_files: dict[str, HelpFile] = {}
-    externals: dict[str, HelpExternal] = {}
+    # No defaults: a NamedTuple would share the same dicts between all indexes.
+    help_files: dict[str, HelpFile]
+    externals: dict[str, HelpExternal]
+    # When set, only the topics in keep_topics are serialized.
+    keep_topics: Container[str] | None = None
+    # When set, the names owned by other files aren't serialized.
+    owners: TopicIndex | None = None
+    # When set, the help files of split documents are serialized as several files.
+    parts: dict[str, list[HelpPart]] | None = None
 
     def as_json(self) -> dict:
-        externals = {url: v.as_json() for url, v in self.externals.items()}
-        help_files = {
-            k: v.as_json() for (k, v) in self.help_files.items() if v.description
-        }
         return {
-            "package": self.package,
-            "description": self.description,
-            "doc_root": f"{self.doc_root.name}/",
-            "help_files": help_files,
-            "externals": externals,
-            "help_contents": list(self.help_files.keys()),
+            key: dict(value) if isinstance(value, Iterator) else value
+            for key, value in self.json_items()
         }
 
-    def save(self) -> Path:
-        output = self.path()
-        output.write_text(json.dumps(self.as_json(), indent=2))
-        return output
+    def json_items(self) -> Iterator[tuple[str, Any]]:
+        """Lazily generates the json representation of the index.
 
-    def path(self) -> Path:
-        return self.doc_root / "hyperhelp.json"
+        The help files and externals are only converted when iterated upon.
+        """
+        yield "package", self.package
+        yield "description", self.description
+        yield "doc_root", f"{self.doc_root.name}/"
+        yield "help_files", (
+            (target, help_file.as_json(source, self.keep_topics, self.owners))
+            for target, source, help_file in self.files()
+            if help_file.description
+        )
+        yield "externals", ((url, v.as_json()) for url, v in self.externals.items())
+        yield "help_contents", [target for target, _, _ in self.files()]
+
+    def files(self) -> Iterator[tuple[str, str, HelpFile]]:
+        """Help files as written on disk: (target, source target, help file).
 
-    def prune(self, keep_topics: set[str]) -> HelpIndex:
-        good_help_files = {}
-        for filename, help_file in self.help_files.items():
-            good_help_files[filename] = prune_file(help_file, keep_topics)
+        The parts of a split document are listed as separate files,
+        but their qualified aliases and owners are still the ones of the document.
+        """
+        parts = self.parts or {}
+        for source, help_file in self.help_files.items():
+            if source not in parts:
+                yield source, source, help_file
+                continue
+            doc_parts = parts[source]
+            ends = [part.start for part in doc_parts[1:]] + [None]
+            defined: set[str] = set()
+            for part, end in zip(doc_parts, ends):
+                yield part.target, source, help_file.part(
+                    part.description, part.start, end, defined
+                )
+
+    @staticmethod
+    def from_json(index: dict, doc_root: Path) -> HelpIndex:
+        json_files = index.get("help_files", {})
+        # help_contents also lists the files without description,
+        # that aren't serialized in help_files.
+        help_files = {
+            name: HelpFile.from_json(json_files.get(name, []), name)
+            for name in index.get("help_contents", json_files.keys())
+        }
+        externals = {
+            uri: HelpExternal.from_json(uri, external)
+            for uri, external in index.get("externals", {}).items()
+        }
         return HelpIndex(
-            self.package,
-            self.description,
-            self.doc_root,
-            good_help_files,
-            self.externals,
+            index["package"], index["description"], doc_root, help_files, externals
         )
 
+    @staticmethod
+    def load(path: Path) -> HelpIndex:
+        """Loads an index previously written by `save`."""
+        return HelpIndex.from_json(json.loads(path.read_text()), path.parent)
+
+    def save(self, output: Path = None, compact: bool = False) -> Path:
+        """Writes the index to disk, one help file at a time.
 
-def prune_topic(self: HelpTopic, keep_topics: set[str]) -> HelpTopic | None:
-    aliases = [a for a in self.aliases if a in keep_topics]
-    if self.topic in keep_topics:
-        return HelpTopic(self.topic, self.caption, aliases)
-    elif aliases:
-        # The main topic need to be pruned, promote an alias
-        return HelpTopic(aliases[0], self.caption, aliases[1:])
-    else:
-        # This topic isn't referenced at all
-        return None
+        The output is the same than `json.dumps(self.as_json(), indent=2)`,
+        or without any whitespace in `compact` mode,
+        but we never hold the full json string in memory.
+        """
+        output = output or self.path()
+        tmp_output = output.with_name(output.name + ".tmp")
+        with open(tmp_output, "w", encoding="utf-8", buffering=2**16) as o:
+            dump_json_items(o, self.json_items(), indent=None if compact else 2)
+        replace_if_changed(tmp_output, output)
+        return output
+
+    def path(self) -> Path:
+        return self.doc_root / "hyperhelp.json"
 
+    def prune(self, keep_topics: Container[str]) -> HelpIndex:
+        """Only keeps the topics in keep_topics, eg a TopicIndex.
 
-def prune_file(self: HelpFile, keep_topics: set[str]) -> HelpFile:
-    good_topics = []
-    for topic in self.topics:
-        good_topic = prune_topic(topic, keep_topics)
-        if good_topic is not None:
-            good_topics.append(good_topic)
-    return HelpFile(self.description, good_topics)
+        The help files aren't modified, the pruning is done when serializing.
+        Topics are kept with their main topic, if any of their names is kept.
+        """
+        return self._replace(keep_topics=keep_topics)
@@ -0,0 +1,92 @@
+"""Cache of the git repositories containing the documentation to build.
+
+Each package has its own clone in `repos/NAME`, that only checks out
+the documentation folder, and only downloads the files of this folder.
+"""
+
+from __future__ import annotations
+
+import logging
+import shutil
+import subprocess
+from pathlib import Path
+from typing import Sequence
+
+logger = logging.getLogger(__name__)
+
+# Folder of the Sphinx project, in the repositories we build.
+DOC_DIR = "doc"
+
+
+def git(srcdir: Path, *args: str) -> None:
+    subprocess.run(["git", "-C", str(srcdir), *args], check=True)
+
+
+def git_config(srcdir: Path, key: str) -> str | None:
+    result = subprocess.run(
+        ["git", "-C", str(srcdir), "config", "--get", key],
+        stdout=subprocess.PIPE,
+        text=True,
+    )
+    return result.stdout.strip() if result.returncode == 0 else None
+
+
+def cached_source(srcdir: Path) -> tuple[str | None, str | None]:
+    """(repo, tag) checked out in srcdir, None when unknown."""
+    if not (srcdir / ".git").exists():
+        return None, None
+    return git_config(srcdir, "remote.origin.url"), git_config(srcdir, "hyperhelp.tag")
+
+
+def checkout(
+    srcdir: Path, repo: str, tag: str = "", sparse: Sequence[str] = (DOC_DIR,)
+) -> bool:
+    """Checks out the given tag of the repository in srcdir.
+
+    The cache entry is keyed by (repo, tag):
+    - if srcdir already has this tag of this repo, nothing is downloaded
+    - if srcdir has another tag of the same repo, only the new tag is fetched
+    - if srcdir was checked out from another repo, it's cloned again.
+    Only the `sparse` folders (and the files at the root) are checked out,
+    and the files of the other folders are never downloaded.
+
+    Folders that weren't checked out by this function, eg put there by hand,
+    are never removed: a ValueError asks to remove them first.
+
+    Returns False if srcdir was already up to date.
+    """
+    cached_repo, cached_tag = cached_source(srcdir)
+    if cached_repo == repo and cached_tag == tag:
+        logger.info(f"Reusing {srcdir} for {repo} {tag}")
+        return False
+    if cached_repo == repo:
+        fetch(srcdir, tag, sparse)
+        return True
+
+    if srcdir.exists():
+        if cached_tag is None:
+            raise ValueError(
+                f"{srcdir} wasn't downloaded by sphinx_hyperhelp, "
+                f"remove it to download {repo}"
+            )
+        logger.info(f"Removing {srcdir}, it was cloned from {cached_repo}")
+        shutil.rmtree(srcdir)
+    srcdir.mkdir(parents=True)
+    try:
+        git(srcdir, "init", "-q")
+        git(srcdir, "remote", "add", "origin", repo)
+        fetch(srcdir, tag, sparse)
+    except BaseException:
+        # Don't leave an empty clone behind.
+        shutil.rmtree(srcdir)
+        raise
+    return True
+
+
+def fetch(srcdir: Path, tag: str, sparse: Sequence[str]) -> None:
+    """Checks out the tag of the origin remote, and records it in the git config."""
+    git(srcdir, "sparse-checkout", "set", *sparse)
+    # Without tag, we use the default branch of the remote.
+    git(srcdir, "fetch", "--depth=1", "--filter=blob:none", "origin", tag or "HEAD")
+    git(srcdir, "checkout", "-q", "--detach", "FETCH_HEAD")
+    git(srcdir, "config", "hyperhelp.tag", tag)
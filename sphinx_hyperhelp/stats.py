@@ -0,0 +1,98 @@
+from __future__ import annotations
+
+import contextlib
+import heapq
+import json
+import marshal
+import time
+from pathlib import Path
+from typing import Iterator, NamedTuple
+
+
+class DocStats(NamedTuple):
+    """Measures of the writing of one document."""
+
+    docname: str
+    seconds: float
+    topics: int
+    links: int
+    externals: int
+    bytes: int
+    # Raw cProfile stats, as in `cProfile.Profile().stats`.
+    # They are a plain dict, so they can be sent back by parallel writers.
+    profile: dict | None = None
+
+    def as_json(self) -> dict:
+        return {
+            "seconds": round(self.seconds, 6),
+            "topics": self.topics,
+            "links": self.links,
+            "externals": self.externals,
+            "bytes": self.bytes,
+        }
+
+
+class BuildStats:
+    """Collects the timings of a build, and writes them to build_stats.json.
+
+    Only the cProfile stats of the `top` slowest documents are kept.
+    """
+
+    def __init__(self, top: int = 0):
+        self.top = top
+        self.docs: dict[str, DocStats] = {}
+        self.phases: dict[str, float] = {}
+        # Heap of the profiled documents, the fastest first.
+        self._profiled: list[tuple[float, str]] = []
+        # Number of references to each external uri, in the whole build.
+        self.externals: dict[str, int] = {}
+
+    def add_doc(self, stats: DocStats) -> None:
+        self.docs[stats.docname] = stats
+        if stats.profile is None:
+            return
+        heapq.heappush(self._profiled, (stats.seconds, stats.docname))
+        if len(self._profiled) > self.top:
+            _, fastest = heapq.heappop(self._profiled)
+            self.docs[fastest] = self.docs[fastest]._replace(profile=None)
+
+    @contextlib.contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0.0) + time.perf_counter() - start
+
+    def slowest(self) -> list[DocStats]:
+        return sorted(self.docs.values(), key=lambda s: s.seconds, reverse=True)
+
+    def save(self, outdir: Path) -> Path:
+        """Writes build_stats.json, and the cProfile dumps in outdir/profiles.
+
+        The dumps can be read with `python -m pstats outdir/profiles/<doc>.prof`.
+        """
+        profiles = {}
+        for stats in self.slowest():
+            if stats.profile is None:
+                continue
+            dump = outdir / "profiles" / (stats.docname + ".prof")
+            dump.parent.mkdir(parents=True, exist_ok=True)
+            # Same format than `cProfile.Profile.dump_stats`
+            with dump.open("wb") as f:
+                marshal.dump(stats.profile, f)
+            profiles[stats.docname] = str(dump.relative_to(outdir))
+
+        output = outdir / "build_stats.json"
+        phases = {"write_doc": sum(s.seconds for s in self.docs.values())}
+        phases.update(self.phases)
+        result = {
+            "phases": {k: round(v, 6) for k, v in phases.items()},
+            "docs": {s.docname: s.as_json() for s in self.slowest()},
+            "profiles": profiles,
+            "externals": dict(
+                sorted(self.externals.items(), key=lambda e: e[1], reverse=True)
+            ),
+        }
+        output.write_text(json.dumps(result, indent=2))
+        return output
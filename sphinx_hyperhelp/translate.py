@@ -0,0 +1,149 @@
+"""Translates a single doctree or reStructuredText snippet, without building.
+
+This runs HyperHelpTranslator in memory: nothing is read or written on disk,
+and there is no index, manifest or cache to load.
+Mostly useful for tests and benchmarks of the translator.
+"""
+
+from __future__ import annotations
+
+import datetime
+import os
+from typing import NamedTuple
+
+from docutils import nodes
+from docutils.core import Publisher
+from docutils.io import NullOutput, StringInput
+from sphinx.application import Sphinx
+from sphinx.config import Config
+from sphinx.io import SphinxDummyWriter, SphinxStandaloneReader
+from sphinx.parsers import RSTParser
+from sphinx.util import rst
+from sphinx.util.docutils import sphinx_domains
+
+from .help_builder import HyperHelpBuilder
+from .help_writer import HyperHelpTranslator, mark_isolated_targets
+from .hyperhelp import HelpDocument, HelpFile, TopicIndex
+
+
+class TranslationContext:
+    """The parts of HyperHelpBuilder used by HyperHelpTranslator.
+
+    - config: Sphinx configuration, with the text_* and hyperhelp_* values
+    - docname: name of the translated document
+    - topic_index: topics of the other documents, used to qualify links and anchors
+    - date: date written in the help file header, defaults to today
+    """
+
+    out_suffix = HyperHelpBuilder.out_suffix
+    get_target_uri = HyperHelpBuilder.get_target_uri
+    get_part_uri = HyperHelpBuilder.get_part_uri
+
+    def __init__(
+        self,
+        config: Config,
+        docname: str = "index",
+        topic_index: TopicIndex | None = None,
+        date: datetime.date | None = None,
+    ):
+        self.config = config
+        self.current_docname = docname
+        self.topic_index = topic_index
+        self.date = date or datetime.date.today()
+        self.secnumbers: dict = {}
+        self._doctree: nodes.document | None = None
+        self._translator: HyperHelpTranslator | None = None
+
+    def get_doc_date(self, docname: str) -> datetime.date:
+        return self.date
+
+    def create_translator(
+        self, document: nodes.document, *args: object
+    ) -> HyperHelpTranslator:
+        return HyperHelpTranslator(document, self)  # type: ignore
+
+
+class Translation(NamedTuple):
+    text: str
+    """Text of the help file."""
+
+    doc: HelpDocument
+    """Topics, links and externals of the document."""
+
+    @property
+    def help_file(self) -> HelpFile:
+        return self.doc.help_file
+
+
+def translate_doctree(
+    doctree: nodes.document,
+    config: Config,
+    docname: str = "index",
+    topic_index: TopicIndex | None = None,
+    date: datetime.date | None = None,
+) -> Translation:
+    """Translates a resolved doctree to HyperHelp.
+
+    The isolated targets are marked again, in case the doctree wasn't read
+    by Sphinx with this extension.
+    """
+    mark_isolated_targets(doctree)
+    context = TranslationContext(config, docname, topic_index, date)
+    translator = context.create_translator(doctree)
+    doctree.walkabout(translator)
+    return Translation(translator.body, translator.doc)
+
+
+def parse_rst(app: Sphinx, text: str, docname: str = "index") -> nodes.document:
+    """Parses a reStructuredText snippet, and resolves its cross references.
+
+    Toctrees are left unresolved, they are skipped by the translator anyway.
+
+    The snippet replaces the document `docname` in the environment of app,
+    but the file itself isn't read, nor written.
+    """
+    env = app.env
+    # Forget the topics and labels of the previous snippet.
+    app.emit("env-purge-doc", env, docname)
+    env.clear_doc(docname)
+    reader = SphinxStandaloneReader()
+    reader.setup(app)
+    parser = RSTParser()
+    parser.set_application(app)
+    # Same as sphinx.io.read_doc, but reading from a string.
+    publisher = Publisher(
+        reader=reader,
+        parser=parser,
+        writer=SphinxDummyWriter(),
+        source_class=StringInput,
+        destination=NullOutput(),
+    )
+    publisher.process_programmatic_settings(None, env.settings, None)
+    publisher.set_source(text, os.path.join(app.srcdir, docname + ".rst"))
+    env.prepare_settings(docname)
+    try:
+        with sphinx_domains(env), rst.default_role(docname, app.config.default_role):
+            publisher.publish()
+    finally:
+        env.temp_data.clear()
+        env.ref_context.clear()
+    doctree = publisher.document
+    assert doctree is not None
+    env.apply_post_transforms(doctree, docname)
+    return doctree
+
+
+def translate_rst(
+    app: Sphinx,
+    text: str,
+    docname: str = "index",
+    topic_index: TopicIndex | None = None,
+    date: datetime.date | None = None,
+) -> Translation:
+    """Translates a reStructuredText snippet to HyperHelp, without building app.
+
+    app only provides the configuration, extensions and domains,
+    it's typically created once and reused for many snippets.
+    """
+    doctree = parse_rst(app, text, docname)
+    return translate_doctree(doctree, app.config, docname, topic_index, date)
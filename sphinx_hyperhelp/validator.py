@@ -0,0 +1,125 @@
+"""Validates an HyperHelp package, without running Sphinx.
+
+Usage: sphinx_hyperhelp --action validate --name PythonDocs
+"""
+
+from __future__ import annotations
+
+import logging
+import mmap
+import re
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import NamedTuple
+
+from .hyperhelp import HelpIndex, TopicIndex, Validation
+
+logger = logging.getLogger(__name__)
+
+# Links: |:topic:text|
+# Anchors: *|topic:⚓|*, *topic:text* and # topic:title
+SCANNER_RE = re.compile(
+    rb"\|:(?P<link>[^:|\n]+):[^|\n]*\|"
+    rb"|\*\|?(?P<anchor>[^\s:*|]+):"
+    rb"|^#+ (?P<title>[^\s:]+):",
+    re.MULTILINE,
+)
+
+
+class ScannedFile(NamedTuple):
+    target: str
+    links: set[str]
+    anchors: set[str]
+
+
+def scan_file(package_dir: Path, target: str) -> ScannedFile:
+    """Finds the links and anchors of one help file."""
+    links: set[str] = set()
+    anchors: set[str] = set()
+    with open(package_dir / target, "rb") as f:
+        try:
+            content = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty files can't be mapped
+            return ScannedFile(target, links, anchors)
+        with content:
+            for match in SCANNER_RE.finditer(content):  # type: ignore
+                link, anchor, title = match.groups()
+                if link:
+                    links.add(link.decode("utf-8"))
+                else:
+                    anchors.add((anchor or title).decode("utf-8"))
+    return ScannedFile(target, links, anchors)
+
+
+def _scan_file(args: tuple[Path, str]) -> ScannedFile:
+    return scan_file(*args)
+
+
+def is_anchored(
+    index: HelpIndex, topic_index: TopicIndex, topic: str, anchors: set[str]
+) -> bool:
+    """Checks that the file defining the topic has an anchor for it."""
+    target, position = topic_index.topics[topic]
+    if position < 0:
+        # Links to a file don't need an anchor.
+        return True
+    # HyperHelp jumps to the anchor of the main topic, not of the aliases.
+    return index.help_files[target].topics[position].topic in anchors
+
+
+def validate_package(package_dir: Path, jobs: int = None) -> Validation:
+    """Checks that all links of an HyperHelp package resolve to exactly one anchor.
+
+    - package_dir: folder containing the hyperhelp.json
+    - jobs: number of processes used to scan the help files
+    """
+    index = HelpIndex.load(package_dir / "hyperhelp.json")
+    topic_index = TopicIndex()
+    for target, help_file in index.help_files.items():
+        topic_index.add_file(target, help_file)
+    externals = {external.topic for external in index.externals.values()}
+
+    targets = [t for t in index.help_files if (package_dir / t).exists()]
+    with ProcessPoolExecutor(jobs) as pool:
+        args = [(package_dir, target) for target in targets]
+        scanned = list(pool.map(_scan_file, args, chunksize=16))
+    anchors = {s.target: s.anchors for s in scanned}
+
+    links: dict[str, str] = {}
+    for s in scanned:
+        for link in sorted(s.links):
+            links.setdefault(link, s.target)
+
+    unresolveds = []
+    conflicts = []
+    for topic, file in links.items():
+        if topic in externals:
+            continue
+        owner = topic_index.resolve(topic)
+        if owner is None or not is_anchored(
+            index, topic_index, topic, anchors.get(owner, set())
+        ):
+            logger.warning(f"Unresolved topic: {topic} in file {file}")
+            unresolveds.append(f"{topic} ({file})")
+        if topic in topic_index.conflicts:
+            conflicting = sorted(topic_index.conflicts[topic])
+            logger.warning(
+                f"In file {file}, topic #{topic} is ambiguous among those files: {', '.join(conflicting)}"
+            )
+            conflicts.append(f"{file}#{topic} - {', '.join(conflicting)}")
+
+    for target in index.help_files:
+        if target not in anchors:
+            logger.warning(f"Missing help file: {target}")
+            unresolveds.append(f"{target} (hyperhelp.json)")
+
+    return Validation(len(links), unresolveds, conflicts)
+
+
+def print_validation(package_dir: Path, validation: Validation) -> None:
+    print(
+        f"{package_dir}: {validation.links} topics linked, "
+        f"{len(validation.unresolved)} unresolved, "
+        f"{len(validation.conflicts)} ambiguous"
+    )
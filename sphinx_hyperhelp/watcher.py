@@ -0,0 +1,71 @@
+"""Watches a source folder for changes, by polling the modification times.
+
+Polling only uses the standard library, and scanning a documentation
+folder takes a few milliseconds, so it's fast enough to react under a second.
+"""
+
+from __future__ import annotations
+
+import os
+import time
+from pathlib import Path
+from typing import Iterable
+
+
+class SourceWatcher:
+    """Reports the files of srcdir that were created, modified or deleted.
+
+    Hidden folders and the `ignore` folders (eg the output folder) are skipped.
+    """
+
+    def __init__(self, srcdir: Path, ignore: Iterable[Path] = ()):
+        self.srcdir = srcdir
+        self.ignore = {os.path.abspath(p) for p in ignore}
+        self.files = self.snapshot()
+
+    def snapshot(self) -> dict[str, tuple[int, int]]:
+        """(modification time, size) of each file, by path relative to srcdir."""
+        files: dict[str, tuple[int, int]] = {}
+        root = os.path.abspath(self.srcdir)
+        folders = [root]
+        while folders:
+            with os.scandir(folders.pop()) as entries:
+                for entry in entries:
+                    if entry.name.startswith("."):
+                        continue
+                    if entry.is_dir(follow_symlinks=False):
+                        if entry.path not in self.ignore:
+                            folders.append(entry.path)
+                    elif entry.is_file():
+                        stat = entry.stat()
+                        path = os.path.relpath(entry.path, root)
+                        files[path] = (stat.st_mtime_ns, stat.st_size)
+        return files
+
+    def changes(self) -> set[str]:
+        """Files that changed since the previous call."""
+        files = self.snapshot()
+        changed = {
+            p
+            for p in files.keys() | self.files.keys()
+            if files.get(p) != self.files.get(p)
+        }
+        self.files = files
+        return changed
+
+    def wait(self, poll: float = 0.1, debounce: float = 0.2) -> set[str]:
+        """Waits for changes, and returns them once no file changed for `debounce` seconds.
+
+        Editors often write several files, or the same file several times,
+        this groups them in a single batch.
+        """
+        changed = self.changes()
+        while not changed:
+            time.sleep(poll)
+            changed = self.changes()
+        while True:
+            time.sleep(debounce)
+            more = self.changes()
+            if not more:
+                return changed
+            changed |= more
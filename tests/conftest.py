@@ -1,17 +1,18 @@
 from __future__ import annotations
 
-import json
+import functools
 import sys
 from pathlib import Path
-from typing import Iterator
-from unittest.mock import MagicMock
+from typing import Callable, Iterator
 
 import pytest
 import sphinx.testing.util
 from sphinx.application import Sphinx
 from sphinx.testing.path import path as SphinxPath
+from sphinx.util.docutils import new_document
 
-from sphinx_hyperhelp import HyperHelpTranslator
+from sphinx_hyperhelp import HyperHelpTranslator, Translation, translate_rst
+from sphinx_hyperhelp.translate import TranslationContext
 
 
 @pytest.fixture()
@@ -40,12 +41,32 @@ def app(monkeypatch, tmp_path: Path) -> Iterator[Sphinx]:
         sys.path[:] = syspath
 
 
+@pytest.fixture(scope="session")
+def snippet_app(tmp_path_factory) -> Iterator[Sphinx]:
+    """A SphinxApp that is never built, shared by the tests translating snippets."""
+    syspath = sys.path[:]
+    srcdir = tmp_path_factory.mktemp("snippets")
+    (srcdir / "conf.py").write_text("")
+    app = sphinx.testing.util.SphinxTestApp("hyperhelp", srcdir=SphinxPath(srcdir))
+    try:
+        yield app
+    finally:
+        app.cleanup()
+        sys.path[:] = syspath
+
+
 @pytest.fixture()
-def hh_translator(app: Sphinx) -> HyperHelpTranslator:
-    """Return an HyperHelp translator.
+def translate(snippet_app: Sphinx) -> Callable[[str], Translation]:
+    """Translates a .rst snippet in memory, much faster than `utils.build_file`.
 
-    Most of the time this will crash because the translator
-    assumes it's working with a builder on a specific document.
-    `build_file_and_doctree(app, rst_file)` will return the translator used.
+    Only the snippet is translated: there is no hyperhelp.json,
+    and the topics aren't qualified by the topics of other documents.
     """
-    return HyperHelpTranslator(document=MagicMock(), builder=app.builder)  # type: ignore
+    return functools.partial(translate_rst, snippet_app)
+
+
+@pytest.fixture()
+def hh_translator(snippet_app: Sphinx) -> HyperHelpTranslator:
+    """Return an HyperHelp translator, for an empty document."""
+    document = new_document("index.rst")
+    return TranslationContext(snippet_app.config).create_translator(document)
@@ -0,0 +1,481 @@
+import gc
+import json
+import os
+import pstats
+import subprocess
+import tracemalloc
+from datetime import date
+from pathlib import Path
+
+from sphinx.application import Sphinx
+from sphinx.environment import BuildEnvironment
+
+from sphinx_hyperhelp import build_package
+from sphinx_hyperhelp.collector import HyperHelpCollector, help_documents
+from sphinx_hyperhelp.help_builder import git_dates
+from sphinx_hyperhelp.hyperhelp import Validation
+from sphinx_hyperhelp.validator import validate_package
+
+from .utils import touch_later
+
+
+def test_incremental_build(app: Sphinx):
+    srcdir, outdir = Path(app.srcdir), Path(app.outdir)
+    (srcdir / "other.rst").write_text("""
+Other
+=====
+
+.. _other-anchor:
+
+Some text about :ref:`index-anchor`.
+""")
+    (srcdir / "index.rst").write_text("""
+.. _index-anchor:
+
+Index
+=====
+
+.. toctree::
+
+   other
+""")
+    app.build()
+    other_mtime = (outdir / "other.txt").stat().st_mtime
+
+    touch_later(
+        srcdir / "index.rst",
+        """
+.. _index-anchor:
+
+Index
+=====
+
+.. toctree::
+
+   other
+
+See :ref:`the other page <other-anchor>`.
+""",
+    )
+    app.build()
+
+    # other.txt wasn't touched, but its topics and links are still in the index.
+    assert (outdir / "other.txt").stat().st_mtime == other_mtime
+    assert (
+        "See |:other.txt/other-anchor:the other page|"
+        in (outdir / "index.txt").read_text()
+    )
+    index = json.loads((outdir / "hyperhelp.json").read_text())
+    assert index["help_contents"] == ["index.txt", "other.txt"]
+    other_topics = [t["topic"] for t in index["help_files"]["other.txt"][1:]]
+    assert "other-anchor" in other_topics
+    assert (outdir / "unresolved.txt").read_text() == ""
+
+
+def test_parallel_write(app: Sphinx):
+    srcdir, outdir = Path(app.srcdir), Path(app.outdir)
+    docs = [f"doc{i}" for i in range(8)]
+    toctree = "\n".join(f"   {doc}" for doc in docs)
+    (srcdir / "index.rst").write_text(f"Index\n=====\n\n.. toctree::\n\n{toctree}\n")
+    for i, doc in enumerate(docs):
+        next_doc = docs[(i + 1) % len(docs)]
+        (srcdir / f"{doc}.rst").write_text(f"""
+.. _{doc}-anchor:
+
+Title {doc}
+===========
+
+Go to :ref:`next <{next_doc}-anchor>` or `python <https://python.org/{doc}>`_.
+""")
+
+    app.parallel = 4
+    app.build()
+    assert app.builder.parallel_ok
+    parallel_index = (outdir / "hyperhelp.json").read_text()
+
+    app.parallel = 1
+    app.builder.build_all()
+    assert not app.builder.parallel_ok
+    assert (outdir / "hyperhelp.json").read_text() == parallel_index
+
+    index = json.loads(parallel_index)
+    assert index["help_contents"] == [f"{d}.txt" for d in docs] + ["index.txt"]
+    assert len(index["externals"]) == len(docs)
+    assert (outdir / "unresolved.txt").read_text() == ""
+
+
+def test_unchanged_files_arent_rewritten(app: Sphinx):
+    srcdir, outdir = Path(app.srcdir), Path(app.outdir)
+    (srcdir / "index.rst").write_text("Index\n=====\n\nHello.\n")
+    app.build()
+    outputs = ["index.txt", "hyperhelp.json", "hyperhelp_manifest.json"]
+    mtimes = {f: (outdir / f).stat().st_mtime_ns for f in outputs}
+
+    app.builder.build_all()
+    assert {f: (outdir / f).stat().st_mtime_ns for f in outputs} == mtimes
+
+    source_date = date.fromtimestamp((srcdir / "index.rst").stat().st_mtime)
+    header = (outdir / "index.txt").read_text().splitlines()[0]
+    assert header == f'%hyperhelp title="Index" date="{source_date:%Y-%m-%d}"'
+
+
+def test_git_dates(tmp_path: Path):
+    def git(*args: str) -> None:
+        env = {**os.environ, "GIT_COMMITTER_DATE": "2020-01-02T12:00:00"}
+        subprocess.run(["git", *args], cwd=tmp_path, env=env, check=True)
+
+    (tmp_path / "doc").mkdir()
+    (tmp_path / "doc" / "index.rst").write_text("Index\n=====\n")
+    git("init", "-q")
+    git("add", ".")
+    git("-c", "user.name=test", "-c", "user.email=test@test", "commit", "-qm", "doc")
+
+    dates = git_dates(tmp_path / "doc")
+    assert dates == {str(tmp_path / "doc" / "index.rst"): date(2020, 1, 2)}
+
+
+def test_build_stats(app: Sphinx):
+    srcdir, outdir = Path(app.srcdir), Path(app.outdir)
+    (srcdir / "index.rst").write_text("""
+Index
+=====
+
+.. toctree::
+
+   other
+
+See `python <https://python.org>`_, `again <https://python.org>`_.
+""")
+    (srcdir / "other.rst").write_text(
+        "Other\n=====\n\nSee :doc:`index` and `python <https://python.org>`_.\n"
+    )
+    setattr(app.config, "hyperhelp_profile", True)
+    setattr(app.config, "hyperhelp_profile_top", 1)
+    app.build()
+
+    stats = json.loads((outdir / "build_stats.json").read_text())
+    assert set(stats["phases"]) == {"write_doc", "validate", "save"}
+    assert set(stats["docs"]) == {"index", "other"}
+    assert stats["docs"]["index"]["externals"] == 1
+    assert stats["docs"]["other"]["links"] == 1
+    assert stats["externals"] == {"https://python.org": 3}
+    assert stats["docs"]["other"]["bytes"] == len((outdir / "other.txt").read_bytes())
+    # Only the slowest document is profiled
+    slowest = next(iter(stats["docs"]))
+    assert stats["profiles"] == {slowest: f"profiles/{slowest}.prof"}
+    pstats.Stats(str(outdir / stats["profiles"][slowest]))
+
+
+def test_build_package(tmp_path: Path):
+    srcdir, outdir = tmp_path / "src", tmp_path / "out"
+    srcdir.mkdir()
+    (srcdir / "conf.py").write_text("extensions = ['sphinx_hyperhelp']\n")
+    (srcdir / "index.rst").write_text("""
+.. _index-anchor:
+
+Index
+=====
+
+See :ref:`the index <index-anchor>`.
+""")
+
+    result = build_package(srcdir, outdir, hyperhelp_prune_topics=False)
+    assert result.status == 0
+    assert list(result.help_index.help_files) == ["index.txt"]
+    assert result.validation == Validation(1, [], [])
+    assert result.validation.valid
+    assert result.cache == (1, 1)
+    doctrees = list((outdir / ".doctrees").iterdir())
+
+    # The second build reuses the environment, and returns the same index.
+    second = build_package(srcdir, outdir, hyperhelp_prune_topics=False)
+    assert second.help_index.as_json() == result.help_index.as_json()
+    assert second.cache.hit_rate == 1.0
+    assert list((outdir / ".doctrees").iterdir()) == doctrees
+
+
+def test_rebuild_keeps_qualified_links(tmp_path: Path):
+    """Unchanged documents aren't written again, but their links are still counted."""
+    srcdir, outdir = tmp_path / "src", tmp_path / "out"
+    srcdir.mkdir()
+    (srcdir / "conf.py").write_text("extensions = ['sphinx_hyperhelp']\n")
+    (srcdir / "index.rst").write_text(
+        "Index\n=====\n\n.. toctree::\n\n   other\n\nUsage\n-----\n\nSee `Usage`_.\n"
+    )
+    (srcdir / "other.rst").write_text("Other\n=====\n\nUsage\n-----\n\nSee `Usage`_.\n")
+
+    first = build_package(srcdir, outdir)
+    assert first.validation.valid
+    second = build_package(srcdir, outdir)
+    assert second.validation.valid
+    assert (outdir / "conflicts.txt").read_text() == ""
+    assert second.help_index.as_json() == first.help_index.as_json()
+    assert validate_package(outdir).valid
+
+
+def test_many_builds_memory(tmp_path: Path):
+    """A process running many builds doesn't keep the previous ones in memory."""
+    srcdir = tmp_path / "src"
+    srcdir.mkdir()
+    (srcdir / "conf.py").write_text("extensions = ['sphinx_hyperhelp']\n")
+    (srcdir / "index.rst").write_text(
+        "Index\n=====\n\nSee :ref:`other-anchor`.\n\n.. toctree::\n\n   other\n"
+    )
+    (srcdir / "other.rst").write_text(
+        ".. _other-anchor:\n\nOther\n=====\n\n.. py:function:: spam(eggs)\n"
+    )
+
+    def build(i: int) -> None:
+        # A new output folder, so the documents are read again.
+        result = build_package(srcdir, tmp_path / f"out{i}")
+        assert result.validation.valid
+
+    tracemalloc.start()
+    try:
+        # The last application is always alive, so it's counted in both measures.
+        build(0)
+        gc.collect()
+        before = tracemalloc.get_traced_memory()[0]
+        environments = count_instances(BuildEnvironment)
+        for i in range(1, 5):
+            build(i)
+        gc.collect()
+        growth = tracemalloc.get_traced_memory()[0] - before
+    finally:
+        tracemalloc.stop()
+
+    assert count_instances(BuildEnvironment) <= environments
+    # Each build used to keep ~200KB.
+    assert growth < 200_000
+
+
+def count_instances(cls: type) -> int:
+    return sum(1 for o in gc.get_objects() if isinstance(o, cls))
+
+
+def test_ambiguous_topics_are_qualified(app: Sphinx):
+    srcdir, outdir = Path(app.srcdir), Path(app.outdir)
+    (srcdir / "index.rst").write_text(
+        "Index\n=====\n\n.. toctree::\n\n   other\n\nUsage\n-----\n\nSee `Usage`_.\n"
+    )
+    (srcdir / "other.rst").write_text("Other\n=====\n\nUsage\n-----\n\nSee `Usage`_.\n")
+    app.build()
+
+    # index.txt comes first and owns "usage", other.txt qualifies it.
+    assert "|:index.txt/usage:Usage|" in (outdir / "index.txt").read_text()
+    other = (outdir / "other.txt").read_text()
+    assert "# other.txt/usage:Usage" in other
+    assert "|:other.txt/usage:Usage|" in other
+    index = json.loads((outdir / "hyperhelp.json").read_text())
+    other_topics = [t["topic"] for t in index["help_files"]["other.txt"][1:]]
+    assert other_topics == ["other", "other.txt/usage"]
+    assert (outdir / "conflicts.txt").read_text() == ""
+    assert validate_package(outdir).valid
+    assert HyperHelpCollector().get_updated_docs(app, app.env) == []
+
+    # "another" comes before "index", so it now owns "usage".
+    # index.rst didn't change, but index.txt is written again.
+    (srcdir / "another.rst").write_text("Another\n=======\n\nUsage\n-----\n")
+    touch_later(
+        srcdir / "other.rst",
+        (srcdir / "other.rst").read_text() + "\n.. toctree::\n\n   another\n",
+    )
+    app.build()
+    assert "# index.txt/usage:Usage" in (outdir / "index.txt").read_text()
+    assert validate_package(outdir).valid
+
+
+def test_anchor_offsets(app: Sphinx):
+    srcdir, outdir = Path(app.srcdir), Path(app.outdir)
+    (srcdir / "index.rst").write_text("""
+.. _index-anchor:
+
+Index
+=====
+
+Some text, with non ascii characters: é, ⚓.
+
+.. _usage:
+
+Usage
+-----
+
+.. py:function:: run(x)
+
+   Runs x.
+""")
+    app.build()
+    offsets = json.loads((outdir / "hyperhelp_offsets.json").read_text())
+    # "index-anchor" is an alias of "index", they share the same anchor.
+    assert offsets["index.txt"] == {
+        "index": [1, 43],
+        "usage": [5, 106],
+        "run": [7, 121],
+    }
+    content = (outdir / "index.txt").read_bytes()
+    lines = content.split(b"\n")
+    for topic, (line, offset) in offsets["index.txt"].items():
+        assert content[:offset].count(b"\n") == line
+        assert topic.encode("utf-8") + b":" in content[offset:].split(b"\n")[0]
+        assert lines[line].endswith(content[offset:].split(b"\n")[0])
+
+
+def test_split_large_documents(app: Sphinx):
+    srcdir, outdir = Path(app.srcdir), Path(app.outdir)
+    setattr(app.config, "hyperhelp_max_file_size", 300)
+    setattr(app.config, "hyperhelp_profile", True)
+    text = "Some long paragraph about this section. " * 4
+    (srcdir / "index.rst").write_text(f"""
+Index
+=====
+
+See :ref:`part-b`.
+
+Part A
+------
+
+{text}
+
+.. _part-b:
+
+Part B
+------
+
+{text}
+
+Part C
+------
+
+Short.
+
+Part D
+------
+
+Short.
+""")
+    app.build()
+    index = json.loads((outdir / "hyperhelp.json").read_text())
+    # B, C and D are small enough to be grouped in the same file.
+    assert index["help_contents"] == ["index.txt", "index.2.txt"]
+    # The label of part B is at the end of part A, but it's the anchor of part B.
+    part_a_topics = [t["topic"] for t in index["help_files"]["index.txt"][1:]]
+    assert "part-b" not in part_a_topics
+    part_b_topics = [t["topic"] for t in index["help_files"]["index.2.txt"][1:]]
+    assert part_b_topics == ["part-b", "part-c", "part-d"]
+    assert "part-b:⚓" not in (outdir / "index.txt").read_text()
+    assert index["help_files"]["index.2.txt"][0] == "Part B"
+    part_b = (outdir / "index.2.txt").read_text()
+    assert part_b.startswith('%hyperhelp title="Part B"')
+    assert "# part-b:Part B" in part_b
+    assert "See |:part-b:Part B|" in (outdir / "index.txt").read_text()
+    offsets = json.loads((outdir / "hyperhelp_offsets.json").read_text())
+    assert list(offsets) == index["help_contents"]
+    assert offsets["index.2.txt"]["part-b"] == [2, 45]
+    stats = json.loads((outdir / "build_stats.json").read_text())
+    written = sum(len((outdir / t).read_bytes()) for t in index["help_contents"])
+    assert stats["docs"]["index"]["bytes"] == written
+    assert validate_package(outdir).valid
+
+
+def test_split_document_shrinks(app: Sphinx):
+    srcdir, outdir = Path(app.srcdir), Path(app.outdir)
+    setattr(app.config, "hyperhelp_max_file_size", 200)
+    text = "Some long paragraph about this section. " * 4
+
+    def sections(n: int) -> str:
+        return "Index\n=====\n" + "".join(
+            f"\nPart {i}\n------\n\n{text}\n" for i in range(n)
+        )
+
+    (srcdir / "index.rst").write_text(sections(3))
+    app.build()
+    assert (outdir / "index.3.txt").exists()
+
+    touch_later(srcdir / "index.rst", sections(2))
+    app.build()
+    index = json.loads((outdir / "hyperhelp.json").read_text())
+    assert index["help_contents"] == ["index.txt", "index.2.txt"]
+    assert not (outdir / "index.3.txt").exists()
+
+    touch_later(srcdir / "index.rst", "Index\n=====\n\nShort.\n")
+    app.build()
+    assert not (outdir / "index.2.txt").exists()
+    assert (outdir / "index.txt").exists()
+    assert validate_package(outdir).valid
+
+
+def test_stream_output(app: Sphinx):
+    srcdir, outdir = Path(app.srcdir), Path(app.outdir)
+    (srcdir / "index.rst").write_text("""
+.. _index-anchor:
+
+Index
+=====
+
+Intro with a :ref:`link <usage>`, and a long enough line to be wrapped by the writer.
+
+.. note:: Some note.
+
+.. _usage:
+
+Usage
+-----
+
+* A list
+* with items
+
+  Term
+     Its definition.
+
+.. py:function:: run(x)
+
+   Runs x.
+
+   .. code-block:: python
+
+      run(1)
+
++-----+-----+
+| a   | b   |
++-----+-----+
+""")
+    app.build()
+    expected = (outdir / "index.txt").read_text()
+    expected_offsets = (outdir / "hyperhelp_offsets.json").read_text()
+
+    setattr(app.config, "hyperhelp_stream_output", True)
+    app.build(force_all=True)
+    assert app.builder.writer.streamed is not None
+    assert (outdir / "index.txt").read_text() == expected
+    assert (outdir / "hyperhelp_offsets.json").read_text() == expected_offsets
+    assert not (outdir / "index.txt.tmp").exists()
+
+    # The stream is written again when the document changes.
+    (srcdir / "index.rst").write_text("Index\n=====\n\nNew content.\n")
+    app.build(force_all=True)
+    assert "New content." in (outdir / "index.txt").read_text()
+
+
+def test_unused_externals_are_pruned(app: Sphinx):
+    srcdir, outdir = Path(app.srcdir), Path(app.outdir)
+    (srcdir / "index.rst").write_text(
+        "Index\n=====\n\n`a <https://a.org>`_ `b <https://b.org>`_\n"
+    )
+    app.build()
+    index = json.loads((outdir / "hyperhelp.json").read_text())
+    assert list(index["externals"]) == ["https://a.org", "https://b.org"]
+
+    (srcdir / "index.rst").write_text("Index\n=====\n\n`b <https://b.org>`_\n")
+    app.build()
+    index = json.loads((outdir / "hyperhelp.json").read_text())
+    assert list(index["externals"]) == ["https://b.org"]
+    assert app.builder.state.externals.refcounts == {"https://b.org": 1}
+
+    # other.txt still links c.org, its collected document is missing.
+    (srcdir / "other.rst").write_text("Other\n=====\n\n`c <https://c.org>`_\n")
+    app.build()
+    help_documents(app.env).pop("other")
+    touch_later(srcdir / "index.rst", "Index\n=====\n")
+    app.build()
+    index = json.loads((outdir / "hyperhelp.json").read_text())
+    assert "https://c.org" in index["externals"]
@@ -0,0 +1,137 @@
+import copy
+import io
+from pathlib import Path
+
+from docutils import nodes
+from sphinx.application import Sphinx
+from sphinx.util.docutils import docutils_namespace
+
+from sphinx_hyperhelp import build_package
+from sphinx_hyperhelp.collector import help_documents
+from sphinx_hyperhelp.validator import validate_package
+
+from .utils import touch_later
+
+OTHER_RST = """
+.. _other-label:
+
+Other page
+==========
+
+.. py:function:: spam(eggs)
+
+   Spam the eggs, see `python <https://www.python.org>`_.
+
+.. glossary::
+
+   builder
+      Something that builds.
+
+.. _isolated-label:
+
+Some text after an isolated target.
+
+.. note:: Notes have titles but no topics.
+"""
+
+INDEX_RST = """
+Index
+=====
+
+.. contents::
+   :local:
+
+.. toctree::
+
+   other
+
+Links
+-----
+
+See :ref:`other-label`, :doc:`other`, :py:func:`spam`,
+:term:`builder` or :ref:`there <isolated-label>`.
+"""
+
+
+def test_collector_matches_translator(app: Sphinx):
+    srcdir = Path(app.srcdir)
+    (srcdir / "other.rst").write_text(OTHER_RST)
+    (srcdir / "index.rst").write_text(INDEX_RST)
+
+    read_documents = {}
+
+    def snapshot(app, env):
+        read_documents.update(copy.deepcopy(help_documents(env)))
+
+    app.connect("env-check-consistency", snapshot)
+    app.build()
+    written_documents = help_documents(app.env)
+
+    assert set(read_documents.keys()) == {"index", "other"}
+    for docname, read_doc in read_documents.items():
+        written_doc = written_documents[docname]
+        assert read_doc is not written_doc
+        assert read_doc.help_file.topics == written_doc.help_file.topics
+        assert read_doc.links == written_doc.links
+        assert read_doc.externals == written_doc.externals
+
+    assert read_documents["index"].links == {
+        "links",
+        "other.txt",
+        "other.txt/other-label",
+        "other.txt/spam",
+        "other.txt/term-builder",
+        "other.txt/isolated-label",
+    }
+    assert "https://www.python.org" in read_documents["other"].externals
+
+
+def test_isolated_targets_are_cached(app: Sphinx):
+    (Path(app.srcdir) / "index.rst").write_text(OTHER_RST)
+    app.build()
+
+    # The targets are marked once when reading, and kept in the cached doctree.
+    doctree = app.env.get_doctree("index")
+    targets = {
+        t.get("refid") or t["ids"][0]: t.get("isolated")
+        for t in doctree.traverse(nodes.target)
+        if t.get("refid") or t.get("ids")
+    }
+    assert targets == {"other-label": False, "python": True, "isolated-label": True}
+
+
+def test_doctrees_shared_with_another_builder(tmp_path: Path):
+    srcdir, doctreedir, outdir = tmp_path / "src", tmp_path / "dt", tmp_path / "out"
+    srcdir.mkdir()
+    (srcdir / "conf.py").write_text("extensions = ['sphinx_hyperhelp']\n")
+    (srcdir / "other.rst").write_text(
+        ".. _other-anchor:\n\nOther\n=====\n\nSee `python <https://docs.python.org>`_.\n"
+        "\n.. _isolated-anchor:\n\nSome text after an isolated target.\n"
+    )
+    index = srcdir / "index.rst"
+    index.write_text(
+        "Index\n=====\n\nSee :ref:`other-anchor`.\n\n.. toctree::\n\n   other\n"
+    )
+    with docutils_namespace():
+        html = Sphinx(
+            str(srcdir),
+            str(srcdir),
+            str(tmp_path / "html"),
+            str(doctreedir),
+            "html",
+            status=io.StringIO(),
+        )
+        html.build()
+
+    # The documents read by the html builder aren't read again.
+    result = build_package(srcdir, outdir, doctreedir)
+    assert result.cache.hit_rate == 1.0
+    assert result.validation.valid
+    assert "*|isolated-anchor:⚓|*" in (outdir / "other.txt").read_text()
+
+    touch_later(index, index.read_text() + "\nMore text.\n")
+    result = build_package(srcdir, outdir, doctreedir)
+    assert result.cache == (2, 1)
+    assert result.validation.valid
+    assert "https://docs.python.org" in result.help_index.externals
+    assert validate_package(outdir).valid
@@ -1,26 +1,29 @@
+import json
 from pathlib import Path
 
-from sphinx_hyperhelp import HelpFile, HelpIndex, HelpTopic
+from sphinx_hyperhelp import HelpExternal, HelpFile, HelpIndex, HelpTopic, TopicIndex
+from sphinx_hyperhelp.hyperhelp import ExternalIndex, HelpDocument, external_topic
+from sphinx_hyperhelp.validator import SCANNER_RE
 
 
 def test_prune():
-    index = HelpIndex("SphinxTest", "nice tests", Path("."))
+    index = HelpIndex("SphinxTest", "nice tests", Path("."), {}, {})
     index.help_files["keep_all.txt"] = HelpFile()
     index.help_files["keep_all.txt"].topics.append(
-        HelpTopic("keep_all", aliases=["keep_all_bis", "keep_all_ter"])
+        HelpTopic("keep_all", aliases=("keep_all_bis", "keep_all_ter"))
     )
 
     index.help_files["keep_main.txt"] = HelpFile()
     index.help_files["keep_main.txt"].topics.append(
-        HelpTopic("keep_main", aliases=["keep_main_bis", "keep_main_ter"])
+        HelpTopic("keep_main", aliases=("keep_main_bis", "keep_main_ter"))
     )
     index.help_files["keep_alias.txt"] = HelpFile()
     index.help_files["keep_alias.txt"].topics.append(
-        HelpTopic("keep_alias", aliases=["keep_alias_bis", "keep_alias_ter"])
+        HelpTopic("keep_alias", aliases=("keep_alias_bis", "keep_alias_ter"))
     )
     index.help_files["drop_all.txt"] = HelpFile()
     index.help_files["drop_all.txt"].topics.append(
-        HelpTopic("drop_all", aliases=["drop_all_bis", "drop_all_ter"])
+        HelpTopic("drop_all", aliases=("drop_all_bis", "drop_all_ter"))
     )
 
     keep_topics = {
@@ -33,10 +36,128 @@ def test_prune():
     index = index.prune(keep_topics=keep_topics)
 
     index_topics = set()
-    for hf in index.help_files.values():
-        for help_topic in hf.topics:
-            index_topics.add(help_topic.topic)
-            index_topics.update(help_topic.aliases)
+    for name, hf in index.help_files.items():
+        for help_topic in hf.as_json(name, index.keep_topics)[1:]:
+            index_topics.add(help_topic["topic"])
+            index_topics.update(help_topic.get("aliases", []))
 
-    assert set(index_topics) == keep_topics
-    assert index.help_files["drop_all.txt"].topics == []
+    # The main topic is the name of the anchor, it's kept with its aliases.
+    assert set(index_topics) == keep_topics | {"keep_alias"}
+    assert index.help_files["drop_all.txt"].as_json("", index.keep_topics) == [""]
+    # The topics are pruned when serializing, the help files aren't modified.
+    assert len(index.help_files["drop_all.txt"].topics) == 1
+
+
+def test_topic_index():
+    topic_index = TopicIndex()
+    topic_index.add_file("a.txt", HelpFile("A", [HelpTopic("a", qualified=True)]))
+    topic_index.add_file("b.txt", HelpFile("B", [HelpTopic("a"), HelpTopic("b")]))
+    topic_index.add_links(["a", "a.txt/a", "b.txt", "missing"])
+    topic_index.add_links(["a"])
+
+    assert topic_index.resolve("a.txt/a") == "a.txt"
+    assert topic_index.resolve("b.txt") == "b.txt"
+    assert topic_index.resolve("missing") is None
+    assert topic_index.conflicts == {"a": {"a.txt", "b.txt"}}
+    # a.txt owns "a", b.txt can only use its qualified alias.
+    assert topic_index.anchor("a.txt", "a") == "a"
+    assert topic_index.anchor("b.txt", "a") == "b.txt/a"
+    assert topic_index.link("b.txt", "a") == "b.txt/a"
+    assert topic_index.link("c.txt", "a") == "a"
+    assert topic_index.refcounts["a"] == 2
+    assert "a" in topic_index and "b" not in topic_index
+
+
+def test_qualified_aliases():
+    topic = HelpTopic("a", "A", ("b",), qualified=True)
+    assert list(topic.names("doc/x.txt")) == ["a", "b", "doc/x.txt/a", "doc/x.txt/b"]
+    assert "b" in topic and "doc/x.txt/b" not in topic
+    assert "doc/y.txt/b" not in list(topic.names("doc/x.txt"))
+    assert topic.as_json("x.txt") == {
+        "topic": "a",
+        "caption": "A",
+        "aliases": ["b", "x.txt/a", "x.txt/b"],
+    }
+    json_topic = topic.as_json("x.txt")
+    assert json_topic is not None
+    assert HelpTopic.from_json(json_topic, "x.txt") == topic
+    # Without the target, qualified aliases are regular aliases.
+    assert HelpTopic.from_json(json_topic).aliases == (
+        "b",
+        "x.txt/a",
+        "x.txt/b",
+    )
+
+    index = HelpIndex("SphinxTest", "nice tests", Path("."), {}, {})
+    index.help_files["x.txt"] = HelpFile("X", [topic])
+    pruned = index.prune({"x.txt/a", "b"})
+    assert pruned.as_json()["help_files"]["x.txt"] == [
+        "X",
+        {"topic": "a", "caption": "A", "aliases": ["b", "x.txt/a"]},
+    ]
+
+
+def test_load(tmp_path):
+    index = HelpIndex("SphinxTest", "nice tests", tmp_path, {}, {})
+    index.help_files["a.txt"] = HelpFile("A", [HelpTopic("a", "A", ("a.txt/a",))])
+    index.help_files["no_title.txt"] = HelpFile()
+    index.externals["https://x.org"] = HelpExternal("x.org", "https://x.org", "X")
+    loaded = HelpIndex.load(index.save())
+
+    assert loaded.as_json() == index.as_json()
+    assert list(loaded.help_files.keys()) == ["a.txt", "no_title.txt"]
+
+
+def test_save(tmp_path):
+    index = HelpIndex("SphinxTest", "nice tests", tmp_path, {}, {})
+    index.help_files["a.txt"] = HelpFile("A", [HelpTopic("a", "A", ("a.txt/a",))])
+    index.help_files["b.txt"] = HelpFile("B\nwith a newline", [HelpTopic("b")])
+    index.externals["https://x.org"] = HelpExternal("x.org", "https://x.org", "X")
+
+    output = index.save()
+    assert output.read_text() == json.dumps(index.as_json(), indent=2)
+    mtime = output.stat().st_mtime_ns
+    index.save()
+    assert output.stat().st_mtime_ns == mtime
+
+    compact = index.save(tmp_path / "compact.json", compact=True)
+    assert compact.read_text() == json.dumps(index.as_json(), separators=(",", ":"))
+    assert not list(tmp_path.glob("*.tmp"))
+
+
+def test_external_topics_dont_collide():
+    uris = [
+        "https://x.org",
+        "https://x.org/",
+        "http://x.org",
+        "ftp://x.org",
+        "https://x.org:8080/a",
+        "https://x.org/~user",
+        "https://x.org/a b",
+        "tel:+33123",
+    ]
+    topics = [external_topic(uri) for uri in uris]
+    assert topics[:4] == ["x.org", "x.org/", "http~x.org", "ftp~x.org"]
+    assert len(set(topics)) == len(uris)
+    for topic in topics:
+        match = SCANNER_RE.fullmatch(f"|:{topic}:text|".encode())
+        assert match and match.group("link") == topic.encode()
+
+
+def test_external_index():
+    docs = [HelpDocument("a", "a.txt"), HelpDocument("b", "b.txt")]
+    x = HelpExternal("x.org", "https://x.org", "X")
+    y = HelpExternal("y.org", "https://y.org", "Y")
+    docs[0].add_external(x)
+    docs[0].add_external(x)
+    docs[1].add_external(x)
+    docs[1].add_external(y)
+    assert docs[0].externals == {x.uri: x}
+
+    external_index = ExternalIndex.from_documents(docs)
+    assert external_index.refcounts == {x.uri: 3, y.uri: 1}
+    assert list(external_index.externals) == [x.uri, y.uri]
+
+    z = HelpExternal("z.org", "https://z.org", "Z")
+    externals = {z.uri: z, y.uri: y, x.uri: x}
+    assert external_index.prune(externals) == {y.uri: y, x.uri: x}
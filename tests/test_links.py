@@ -1,11 +1,13 @@
+import random
 import re
+import textwrap
 from pathlib import Path
 
 import docutils.nodes
 from sphinx.application import Sphinx
 
 from sphinx_hyperhelp import HelpTopic
-from sphinx_hyperhelp.help_writer import TopicRef
+from sphinx_hyperhelp.help_writer import WORDSEP_RE, LineWrapper, TopicRef
 
 from . import utils
 from .utils import build_file, build_file_and_doctree
@@ -78,7 +80,7 @@ Documentation using the alabaster theme
     assert f"  * xxx {ALABSTER_THEME}" in help_file
 
 
-def test_wrap_short_lines(app):
+def test_wrap_short_lines(translate):
     rst_file = f"""
 this
 should
@@ -86,14 +88,14 @@ all be
 on the same line
 .
 """
-    help_file, _ = build_file(app, rst_file)
+    help_file = translate(rst_file).text
     assert "this should all be on the same line ." in help_file
 
 
-def test_todo(app):
+def test_todo(translate):
     rst_file = """hello
     .. todo:: Populate when the 'builders' document is split up."""
-    help_file, _ = build_file(app, rst_file)
+    help_file = translate(rst_file).text
     assert "Populate when the 'builders' document is split up." not in help_file
 
 
@@ -223,3 +225,40 @@ can be used by `type`_ settings.
     assert len(topics) == 2
     assert topics[0]["topic"] == "configuration"
     assert topics[1]["topic"] == "type"
+
+
+def test_line_wrapper_matches_textwrap():
+    rng = random.Random(0)
+    words = [
+        "word",
+        "a",
+        "long-winded",
+        "em--dash",
+        " ",
+        "   ",
+        "\t",
+        "\n",
+        ":ref:`target`",
+        "x" * 30,
+        TopicRef(ALABSTER_THEME),
+        TopicRef("|:topic:short|"),
+    ]
+    for _ in range(200):
+        fragments = ["".join(rng.choices(words, k=rng.randint(1, 5)))]
+        fragments += [rng.choice(words) for _ in range(rng.randint(0, 20))]
+        width = rng.randint(10, 80)
+
+        textwrapper = textwrap.TextWrapper(width=width, break_long_words=False)
+        textwrapper.wordsep_re = WORDSEP_RE
+        chunks: list[str] = []
+        for fragment in fragments:
+            if isinstance(fragment, TopicRef):
+                chunks.append(fragment)
+            else:
+                chunks.extend(
+                    textwrapper._split(textwrapper._munge_whitespace(fragment))
+                )
+
+        wrapper = LineWrapper(width)
+        assert wrapper.split(fragments) == chunks
+        assert wrapper.wrap(fragments) == textwrapper._wrap_chunks(chunks)
@@ -0,0 +1,267 @@
+import json
+import logging
+import subprocess
+import sys
+import threading
+from pathlib import Path
+
+import pytest
+
+from sphinx_hyperhelp import BuildResult, __main__, batch, sources
+
+from .utils import touch_later
+
+
+def make_repo(path: Path, index: str) -> str:
+    (path / "doc").mkdir(parents=True)
+    (path / "doc" / "conf.py").write_text("project = 'test'\n")
+    (path / "doc" / "index.rst").write_text(index)
+
+    def git(*args: str) -> None:
+        subprocess.run(["git", *args], cwd=path, check=True)
+
+    git("init", "-q")
+    git("add", ".")
+    git("-c", "user.name=test", "-c", "user.email=test@test", "commit", "-qm", "doc")
+    return path.resolve().as_uri()
+
+
+def test_batch_build(tmp_path: Path, monkeypatch, capsys):
+    monkeypatch.chdir(tmp_path)
+    manifest = tmp_path / "manifest.json"
+    manifest.write_text(
+        json.dumps(
+            {
+                "first": {"repo": make_repo(tmp_path / "first", "First\n=====\n")},
+                "second": {"repo": make_repo(tmp_path / "second", "Second\n======\n")},
+                "missing": {"repo": (tmp_path / "missing").as_uri()},
+            }
+        )
+    )
+    with pytest.raises(SystemExit):
+        __main__._dispatch(manifest=manifest, action="build", jobs=2)
+
+    for name in ["first", "second"]:
+        assert (tmp_path / "build" / name / "hyperhelp" / "index.txt").exists()
+    assert not (tmp_path / "build" / "missing").exists()
+
+    summary = capsys.readouterr().out.splitlines()
+    assert summary[0].split() == ["package", "status", "download", "build"]
+    statuses = {line.split()[0]: line.split()[1] for line in summary[1:4]}
+    assert statuses == {"first": "ok", "second": "ok", "missing": "failed"}
+    assert summary[4].startswith("missing failed: CalledProcessError")
+
+
+def test_batch_build_python_m(tmp_path: Path):
+    """The build workers can be spawned when running `python -m sphinx_hyperhelp`."""
+    manifest = tmp_path / "manifest.json"
+    manifest.write_text(
+        json.dumps({"first": {"repo": make_repo(tmp_path / "first", "First\n=====\n")}})
+    )
+    subprocess.run(
+        [sys.executable, "-m", "sphinx_hyperhelp"]
+        + ["--manifest", str(manifest), "--action", "build"],
+        cwd=tmp_path,
+        check=True,
+    )
+    assert (tmp_path / "build" / "first" / "hyperhelp" / "index.txt").exists()
+
+
+def test_batch_broken_worker(tmp_path: Path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    # A lambda can't be sent to the worker process, so its future fails.
+    monkeypatch.setattr(batch, "build", lambda *args: None)
+    repo = make_repo(tmp_path / "first", "First\n=====\n")
+    results = __main__.process_packages({"first": (repo, ""), "second": (repo, "")})
+    assert [r.name for r in results] == ["first", "second"]
+    assert all("pickle" in r.error for r in results)
+
+
+def test_download_cache(tmp_path: Path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    source = tmp_path / "source"
+    repo = make_repo(source, "Version 1\n=========\n")
+    (source / "src").mkdir()
+    (source / "src" / "code.py").write_text("print('not documentation')\n")
+
+    def git(*args: str) -> None:
+        subprocess.run(["git", "-C", str(source), *args], check=True)
+
+    git("config", "uploadpack.allowFilter", "true")
+    git("add", ".")
+    git("-c", "user.name=test", "-c", "user.email=test@test", "commit", "-qm", "v1")
+    git("tag", "v1")
+    (source / "doc" / "index.rst").write_text("Version 2\n=========\n")
+    git("-c", "user.name=test", "-c", "user.email=test@test", "commit", "-qam", "v2")
+    git("tag", "v2")
+
+    srcdir = __main__.download("pkg", repo, "v1")
+    assert srcdir == Path("repos") / "pkg"
+    assert (srcdir / "doc" / "index.rst").read_text().startswith("Version 1")
+    # Only the documentation is checked out.
+    assert not (srcdir / "src").exists()
+    # and the other files aren't downloaded.
+    missing = subprocess.run(
+        ["git", "-C", str(srcdir), "rev-list", "--objects", "--missing=print", "HEAD"],
+        stdout=subprocess.PIPE,
+        text=True,
+        check=True,
+    ).stdout.split()
+    assert len([m for m in missing if m.startswith("?")]) == 1
+    assert sources.cached_source(srcdir) == (repo, "v1")
+
+    assert not sources.checkout(srcdir, repo, "v1")
+    # Changing the tag fetches it in the same clone.
+    (srcdir / ".git" / "marker").touch()
+    assert sources.checkout(srcdir, repo, "v2")
+    assert (srcdir / ".git" / "marker").exists()
+    assert (srcdir / "doc" / "index.rst").read_text().startswith("Version 2")
+
+    # Another repository is cloned again.
+    other = make_repo(tmp_path / "other", "Other\n=====\n")
+    assert sources.checkout(srcdir, other, "")
+    assert not (srcdir / ".git" / "marker").exists()
+    assert (srcdir / "doc" / "index.rst").read_text().startswith("Other")
+    assert sources.cached_source(srcdir) == (other, "")
+
+    # Sources put there by hand are never removed.
+    by_hand = tmp_path / "repos" / "by_hand"
+    (by_hand / "doc").mkdir(parents=True)
+    (by_hand / "doc" / "index.rst").write_text("By hand\n=======\n")
+    with pytest.raises(ValueError, match="remove it"):
+        sources.checkout(by_hand, repo, "v1")
+    assert (by_hand / "doc" / "index.rst").exists()
+
+    # A failed clone doesn't leave an empty folder.
+    with pytest.raises(subprocess.CalledProcessError):
+        sources.checkout(tmp_path / "repos" / "missing", repo, "missing-tag")
+    assert not (tmp_path / "repos" / "missing").exists()
+
+
+def test_doctree_cache(tmp_path: Path, monkeypatch, capsys):
+    monkeypatch.chdir(tmp_path)
+    repo = make_repo(tmp_path / "source", "Index\n=====\n")
+    __main__.build("pkg", repo, outdir=tmp_path / "first")
+    # A fresh output folder reuses the parsed documents.
+    __main__.build("pkg", repo, outdir=tmp_path / "second")
+    assert (tmp_path / "second" / "hyperhelp" / "index.txt").exists()
+
+    out = capsys.readouterr().out.splitlines()
+    doctreedir = __main__.doctree_cache("pkg", Path("repos") / "pkg" / "doc")
+    assert doctreedir.exists()
+    assert out[-2] == f"pkg: reused 0/1 parsed documents (0%) from {doctreedir}"
+    assert out[-1] == f"pkg: reused 1/1 parsed documents (100%) from {doctreedir}"
+
+
+def test_lazy_imports():
+    code = (
+        "import sys, sphinx_hyperhelp\n"
+        "from sphinx_hyperhelp.__main__ import download\n"
+        "assert sphinx_hyperhelp.main\n"
+        "print(sorted({m.split('.')[0] for m in sys.modules} & {'sphinx', 'docutils'}))"
+    )
+    result = subprocess.run(
+        [sys.executable, "-c", code], stdout=subprocess.PIPE, text=True, check=True
+    )
+    assert result.stdout.strip() == "[]"
+    # The other names are imported on demand.
+    import sphinx_hyperhelp
+
+    assert sphinx_hyperhelp.setup is sphinx_hyperhelp.help_builder.setup
+    with pytest.raises(AttributeError):
+        sphinx_hyperhelp.missing
+
+
+def test_watch_package(tmp_path: Path):
+    srcdir, outdir = tmp_path / "src", tmp_path / "out"
+    srcdir.mkdir()
+    (srcdir / "conf.py").write_text("")
+    (srcdir / "index.rst").write_text("Index\n=====\n\n.. toctree::\n\n   other\n")
+    (srcdir / "other.rst").write_text("Other\n=====\n\nBefore.\n")
+    builds: list = []
+    first_build = threading.Event()
+
+    def on_build(result: BuildResult, changed: set, duration: float) -> None:
+        builds.append((result, changed))
+        first_build.set()
+
+    watcher = threading.Thread(
+        target=__main__.watch_package,
+        args=(srcdir, outdir),
+        kwargs=dict(on_build=on_build, max_builds=2, debounce=0.05),
+    )
+    watcher.start()
+    assert first_build.wait(timeout=30)
+    other = srcdir / "other.rst"
+    touch_later(other, "Other\n=====\n\nAfter.\n")
+    watcher.join(timeout=30)
+    assert not watcher.is_alive()
+
+    (first, _), (second, changed) = builds
+    assert first.cache.read == 2
+    # Only the modified document is read again.
+    assert changed == {"other.rst"}
+    assert second.cache.read == 1
+    assert "After." in (outdir / "other.txt").read_text()
+
+
+FAILING_CONF = """
+import os
+
+def setup(app):
+    def check(app, env, docnames):
+        if os.path.exists(os.path.join(app.srcdir, "FAIL")):
+            raise RuntimeError("Build failed on purpose")
+
+    app.connect("env-before-read-docs", check)
+"""
+
+
+def test_watch_package_errors(tmp_path: Path):
+    srcdir, outdir = tmp_path / "src", tmp_path / "out"
+    srcdir.mkdir()
+    conf = srcdir / "conf.py"
+    conf.write_text(FAILING_CONF)
+    (srcdir / "index.rst").write_text("Index\n=====\n")
+    builds: list = []
+    errors: list = []
+    done = threading.Semaphore(0)
+
+    def on_build(result: BuildResult, changed: set, duration: float) -> None:
+        builds.append(changed)
+        done.release()
+
+    class ErrorHandler(logging.Handler):
+        def emit(self, record: logging.LogRecord) -> None:
+            errors.append(record.getMessage())
+            if record.getMessage().startswith("Failed to build"):
+                done.release()
+
+    handler = ErrorHandler(logging.ERROR)
+    __main__.logger.addHandler(handler)
+    watcher = threading.Thread(
+        target=__main__.watch_package,
+        args=(srcdir, outdir),
+        kwargs=dict(on_build=on_build, max_builds=4, debounce=0.05),
+    )
+    watcher.start()
+    try:
+        assert done.acquire(timeout=30)
+        # An invalid configuration is ignored.
+        conf.write_text(FAILING_CONF + "\nextensions = [\n")
+        assert done.acquire(timeout=30)
+        (srcdir / "FAIL").write_text("")
+        assert done.acquire(timeout=30)
+        (srcdir / "FAIL").unlink()
+        conf.write_text(FAILING_CONF)
+        watcher.join(timeout=30)
+        assert not watcher.is_alive()
+    finally:
+        __main__.logger.removeHandler(handler)
+
+    assert builds == [set(), {"conf.py"}, {"conf.py", "FAIL"}]
+    # The configuration is read again until it's fixed.
+    assert len(errors) == 3
+    assert errors[0].startswith("Invalid configuration")
+    assert errors[1].startswith("Invalid configuration")
+    assert errors[2].startswith("Failed to build")
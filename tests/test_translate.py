@@ -0,0 +1,85 @@
+from io import StringIO
+from pathlib import Path
+from typing import cast
+
+from sphinx import addnodes
+from sphinx.application import Sphinx
+
+from sphinx_hyperhelp import translate_doctree
+from sphinx_hyperhelp.translate import parse_rst
+
+from .utils import build_file
+
+SNIPPET_RST = """
+.. _snippet-label:
+
+Snippet
+=======
+
+Calls :py:func:`spam`, see also :ref:`snippet-label`
+and `python <https://www.python.org>`_.
+
+.. py:function:: spam(eggs)
+
+   Spam the eggs.
+
+.. _isolated-label:
+
+Some text after an isolated target.
+
+Section
+-------
+
+.. glossary::
+
+   builder
+      Something that builds.
+"""
+
+
+def test_translate_same_as_build(app: Sphinx, translate):
+    help_file, help_index = build_file(app, SNIPPET_RST)
+    translation = translate(SNIPPET_RST)
+
+    assert translation.text == help_file
+    assert (
+        translation.help_file.as_json("index.txt")
+        == help_index["help_files"]["index.txt"]
+    )
+    assert {e.uri for e in translation.doc.externals.values()} == set(
+        help_index["externals"]
+    )
+    assert "spam" in translation.doc.links
+
+
+def test_translate_without_build(snippet_app: Sphinx, translate):
+    outdir = Path(snippet_app.outdir)
+    warnings = cast(StringIO, snippet_app._warning)
+    translate(SNIPPET_RST)
+    previous_warnings = len(warnings.getvalue())
+    # Translating the same labels again isn't a duplicate.
+    translation = translate(SNIPPET_RST.replace("Spam the eggs", "Eat the spam"))
+
+    assert "Eat the spam" in translation.text
+    assert "Spam the eggs" not in translation.text
+    assert "duplicate" not in warnings.getvalue()[previous_warnings:]
+    assert not outdir.exists() or not any(outdir.iterdir())
+
+
+def test_translate_doctree(snippet_app: Sphinx):
+    doctree = parse_rst(snippet_app, SNIPPET_RST, "usage/snippet")
+    assert not doctree.next_node(addnodes.pending_xref)
+
+    translation = translate_doctree(doctree, snippet_app.config, "usage/snippet")
+    assert translation.doc.target == "usage/snippet.txt"
+    assert translation.help_file.description == "Snippet"
+    topics = [t.topic for t in translation.help_file.topics]
+    assert topics == [
+        "snippet",
+        "python",
+        "spam",
+        "isolated-label",
+        "section",
+        "term-builder",
+    ]
+    assert "|:snippet-label:Snippet|" in translation.text
@@ -0,0 +1,60 @@
+from pathlib import Path
+
+from sphinx.application import Sphinx
+
+from sphinx_hyperhelp.validator import scan_file, validate_package
+
+
+def test_scan_file(tmp_path: Path):
+    (tmp_path / "a.txt").write_text("""%hyperhelp title="A" date="2022-01-01"
+*|a:⚓|*
+
+# section:Section
+
+*func:func(x, *, y)* calls |:other.txt/b:other function| and |:section:this|.
+""")
+    scanned = scan_file(tmp_path, "a.txt")
+    assert scanned.links == {"other.txt/b", "section"}
+    assert scanned.anchors == {"a", "section", "func"}
+
+    (tmp_path / "empty.txt").write_text("")
+    assert scan_file(tmp_path, "empty.txt").links == set()
+
+
+def test_validate_package(app: Sphinx):
+    srcdir, outdir = Path(app.srcdir), Path(app.outdir)
+    (srcdir / "index.rst").write_text("""
+.. _index-anchor:
+
+Index
+=====
+
+.. toctree::
+
+   other
+
+See :ref:`the other page <other-anchor>`.
+""")
+    (srcdir / "other.rst").write_text("""
+.. _other-anchor:
+
+Other
+=====
+
+Back to :ref:`index <index-anchor>`.
+""")
+    app.build()
+    validation = validate_package(outdir, jobs=2)
+    assert validation.valid
+    assert validation.links == 3
+
+    other = outdir / "other.txt"
+    other.write_text(
+        other.read_text().replace("*|other:⚓|*", "")
+        + "\nSee |:missing:missing topic|.\n"
+    )
+    validation = validate_package(outdir, jobs=2)
+    assert validation.unresolved == [
+        "other.txt/other-anchor (index.txt)",
+        "missing (other.txt)",
+    ]
@@ -1,6 +1,7 @@
 from __future__ import annotations
 
 import json
+import os
 from pathlib import Path
 from typing import Callable, TypeVar
 
@@ -23,14 +24,21 @@ def build_file(app: Sphinx, content: str) -> tuple[str, dict]:
     return help_file, json_index
 
 
+def touch_later(file: Path, content: str) -> None:
+    """Writes the file and makes sure its mtime is newer than previous outputs."""
+    file.write_text(content)
+    mtime = file.stat().st_mtime + 10
+    os.utime(file, (mtime, mtime))
+
+
 def build_file_and_doctree(
     app: Sphinx, content: str
 ) -> tuple[str, dict, docutils.nodes.document, HyperHelpTranslator]:
     """Converts one .rst file to hyperhelp.
 
     Also return the index, the parsed doctree and the translator object.
-    Note: the translator object is "closed" and some methods might not work.
-    We may need to add a factory that creates and prepares a translator.
+    Note: the translator object is "closed" and some methods might not work,
+    the `hh_translator` fixture creates a new one.
     """
     help_file, json_index = build_file(app, content)
     doctree = app.builder._doctree  # type: ignore